@@ -200,7 +200,7 @@ def main():
     print ""
     print "Vehicle Sensor readings:"
     print "--------------------"
-    pprint.pprint( vehicle.sensor_readings )
+    pprint.pprint( vehicle.sensor_readings.as_dict() )
     print ""
     print "-----------------------------------"
     print "END"
@@ -113,6 +113,9 @@ def main():
     reader.Port = port
     reader.Headers = 1
 
+    # skip the protocol search when this adapter or vehicle has been seen before
+    reader.ProtoCache = 'obd2_protocols'
+
     # we want a record of what we pulled
     reader.record_trace()
 
@@ -149,6 +152,12 @@ def main():
     print "Loading default DTC definitions from CSV file..."
     obd2.load_dtcs_from_csv( 'obd2_std_DTCs.csv' )
 
+    # manufacturer and local definitions stack on top of the standard ones,
+    #   they are only read when the VIN of the vehicle matches one of the WMIs
+    #obd2.load_pids_from_csv( 'honda_PIDs.csv', 'mfr', ['1HG', 'JHM'] )
+    #obd2.load_dtcs_from_csv( 'honda_DTCs.csv', 'mfr', ['1HG', 'JHM'] )
+    #obd2.load_dtcs_from_csv( 'fleet_DTCs.csv', 'fleet' )
+
 
     
     
@@ -156,7 +165,9 @@ def main():
     #reader.RTRV_record()
     print ""
     print "Scanning vehicle for supported features..."
-    vehicle.scan_features()
+    # vehicles seen before are recognized by VIN & CALID and skip the full scan
+    if vehicle.scan_features_cached( 'obd2_capabilities' ):
+        print "Known vehicle, using saved capabilities"
     
     #print ""
     #print "Supported PIDs - DEBUG"
@@ -211,8 +222,27 @@ def main():
         vehicle.scan_pid( pid )
         vehicle.show_last_reading( pid )
     print " "
+    print " Polling for 10 seconds: RPM at 10 Hz, speed at 5 Hz, other sensors at 0.5 Hz"
+    rates = {}
+    for pid in sensors:
+        rates[pid] = 0.5
+    rates['010C'] = 10
+    rates['010D'] = 5
+    # check the plan against the round trip times measured so far
+    plan = vehicle.plan_polls( rates )
+    print " Predicted link utilization: %d%%" % (100 * plan['utilization'])
+    if len(plan['misses']) > 0:
+        print " Will miss requested rate:", ' '.join(plan['misses'])
+    vehicle.apply_plan( plan )
+    vehicle.poll( 10 )
+    rates = vehicle.poll_rates()
+    for pid in sorted(rates.keys()):
+        print pid.rjust(16), ": ", "%5.2f Hz requested, %5.2f Hz achieved" % tuple(rates[pid])
+    for [pid, fails, error, probe] in vehicle.quarantined():
+        print pid.rjust(16), ": ", "QUARANTINED after %d x %s, next probe in %d s" % (fails, error, probe)
+    print " "
     print " RAW Data structure:"
-    pprint.pprint( vehicle.sensor_readings )
+    pprint.pprint( vehicle.sensor_readings.as_dict() )
     
 
     print " "
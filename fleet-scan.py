@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+############################################################################
+#
+# fleet-scan.py
+#
+# Copyright 2011 Austin Murphy (austin.murphy@gmail.com)
+#
+# This file is part of OBD2 Scantool.
+#
+# OBD2 Scantool is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# OBD2 Scantool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OBD2 Scantool; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+############################################################################
+
+
+#
+#  Scan several vehicles at once, one OBD2 interface per vehicle
+#
+
+#
+#  With the vehicles ON (Engine can be either OFF or RUNNING)
+#  Attach an OBD2 interface to each vehicle and to the computer
+#  Run this script with the serial ports to use, or none to use all of them
+#
+#  Each vehicle gets a report in the fleet-<date> directory,
+#    followed by a summary of all of them
+#
+
+
+import sys, os, time, glob
+
+# each vehicle is scanned in its own process,
+#   PID & DTC definitions are picked per vehicle (by VIN) and are global in obd2
+import multiprocessing
+import Queue
+
+# req'd by obd2_reader
+import serial
+
+# req'd by obd2
+import obd2_reader
+
+# main OBD2 object
+import obd2
+
+
+# debug
+import pprint
+
+
+# where to look for OBD2 interfaces when no ports are given
+port_patterns = ['/dev/ttyUSB*', '/dev/ttyACM*', '/dev/rfcomm*']
+
+# give up on a vehicle after this many seconds
+bay_timeout = 180
+
+ser_settings = {
+ 'baudrate': 38400,
+ 'bytesize': serial.EIGHTBITS,
+ 'parity'  : serial.PARITY_NONE,
+ 'stopbits': serial.STOPBITS_ONE,
+ 'xonxoff' : False,
+ 'rtscts'  : False,
+ 'dsrdtr'  : False,
+ 'timeout' : None,
+ 'interCharTimeout': None,
+ 'writeTimeout'    : None
+}
+
+
+
+def scan_bay(ser_device, reportfile, results):
+    """ Scan one vehicle, write its report, and put a summary on the results queue """
+
+    summary = { 'port'   : ser_device,
+                'report' : reportfile,
+                'status' : 'FAILED',
+                'VIN'    : "Unknown",
+                'MIL'    : "Unknown",
+                'DTCs'   : [],
+                'start'  : time.time() }
+
+    # everything printed goes into the report
+    sys.stdout = open(reportfile, 'w')
+
+    print "=================================================================="
+    print ""
+    print "OBD2 vehicle scan"
+    print "-----------------"
+    print ""
+    print "Scan date: ", time.ctime()
+    print "Device".rjust(16), ": ", ser_device
+
+    try:
+        # create serial port (closed)
+        port = serial.Serial(None)
+        port.port = ser_device
+        port.applySettingsDict(ser_settings)
+
+        # create reader object (disconnected)
+        reader = obd2_reader.OBD2reader( 'SERIAL', 'ELM327' )
+        reader.Port = port
+        reader.Headers = 1
+
+        reader.connect()   # this also opens the serial port
+
+        print ""
+        print "=================================================================="
+        print ""
+        print "OBD2 reader device"
+        print "------------------"
+        for k in sorted(reader.attr.keys()):
+            print k.rjust(16), ": ", reader.attr[k]
+
+        vehicle = obd2.OBD2( reader )
+        vehicle.scan_features()
+
+        print ""
+        print "=================================================================="
+        print " "
+        print "General vehicle info"
+        print "--------------------"
+        vehicle.scan_basic_info()
+        vehicle.show_basic_info()
+        summary['VIN'] = vehicle.info['7E8']['VIN']
+
+        print ""
+        print "=================================================================="
+        print " "
+        print "Diagnostic and Emmissions Monitor info"
+        print "--------------------------------------"
+        vehicle.scan_obd2_status()
+        vehicle.scan_pid( '03' )
+        pprint.pprint( vehicle.obd2status )
+        print " "
+        print " DTCs:"
+        vehicle.show_last_reading( '03' )
+
+        summary['MIL'] = vehicle.obd2status['7E8']['MIL']
+        for ecu in sorted(vehicle.obd2status.keys()):
+            summary['DTCs'].extend( vehicle.obd2status[ecu].get('DTCs', []) )
+
+        reader.disconnect()
+        summary['status'] = 'OK'
+
+    except Exception as e:
+        print ""
+        print "Scan failed: ", repr(e)
+        summary['error'] = repr(e)
+
+    print ""
+    print "=================================================================="
+
+    sys.stdout.flush()
+    summary['elapsed'] = time.time() - summary['start']
+    results.put(summary)
+
+
+
+def show_summary(bays):
+    """ One line per vehicle """
+    print "Port".ljust(16), "Status".ljust(8), "VIN".ljust(18), "MIL".ljust(8), "Time".rjust(6), "  DTCs"
+    for b in bays:
+        print b['port'].ljust(16), b['status'].ljust(8), str(b['VIN']).ljust(18), str(b['MIL']).ljust(8), \
+              ("%5.1fs" % b['elapsed']).rjust(6), " ", ' '.join(b['DTCs'])
+
+
+
+def main():
+    """ Scan all the vehicles at once """
+
+    ports = sys.argv[1:]
+    if ports == []:
+        for pattern in port_patterns:
+            ports.extend( sorted(glob.glob(pattern)) )
+    if ports == []:
+        sys.exit('Usage: %s [serial port ...]   (no OBD2 interfaces found)' % sys.argv[0])
+
+    print "=================================================================="
+    print ""
+    print "OBD2 fleet scan"
+    print "---------------"
+    print ""
+    print "Scan date: ", time.ctime()
+    print "Ports:     ", ' '.join(ports)
+
+    reportdir = time.strftime("fleet-%Y%m%d-%H%M%S")
+    os.mkdir(reportdir)
+    print "Reports:   ", reportdir
+
+    # load the definitions once, every vehicle process gets a copy
+    obd2.load_pids_from_csv( 'obd2_std_PIDs.csv' )
+    obd2.load_dtcs_from_csv( 'obd2_std_DTCs.csv' )
+
+    # one process per vehicle, a slow or stuck one doesn't hold up the others
+    results = multiprocessing.Queue()
+    bays = {}
+    for ser_device in ports:
+        reportfile = os.path.join( reportdir, os.path.basename(ser_device) + ".txt" )
+        p = multiprocessing.Process( target=scan_bay, args=(ser_device, reportfile, results) )
+        p.start()
+        bays[ser_device] = { 'port'    : ser_device,
+                             'report'  : reportfile,
+                             'status'  : 'RUNNING',
+                             'VIN'     : "Unknown",
+                             'MIL'     : "Unknown",
+                             'DTCs'    : [],
+                             'start'   : time.time(),
+                             'elapsed' : 0,
+                             'process' : p }
+
+    # collect the results as they come in, until the last one or the timeout
+    started = time.time()
+    waiting = len(bays)
+    while waiting > 0 and time.time() < started + bay_timeout:
+        try:
+            summary = results.get( True, started + bay_timeout - time.time() )
+        except Queue.Empty:
+            break
+        bays[ summary['port'] ].update(summary)
+        waiting -= 1
+        print "  done: ", summary['port'].ljust(16), summary['status'], "(%.1fs)" % summary['elapsed']
+
+    for b in bays.values():
+        if b['status'] == 'RUNNING':
+            b['process'].terminate()
+            b['status']  = 'TIMEOUT'
+            b['elapsed'] = time.time() - b['start']
+        b['process'].join()
+        del b['process']
+
+    print ""
+    print "=================================================================="
+    print ""
+    print "Summary"
+    print "-------"
+    print ""
+    bays = [ bays[p] for p in ports ]
+    show_summary(bays)
+
+    # and keep a copy with the reports
+    stdout = sys.stdout
+    sys.stdout = open( os.path.join(reportdir, "summary.txt"), 'w' )
+    show_summary(bays)
+    sys.stdout.close()
+    sys.stdout = stdout
+
+    print ""
+    print "Total time: %.1fs" % (time.time() - started)
+    print "=================================================================="
+
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
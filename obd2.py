@@ -45,6 +45,30 @@ import csv
 # for hex to ascii conversion
 import binascii
 
+# for caching the parsed CSV files
+import os
+import sys
+import marshal
+
+# for the per-vehicle capability cache
+import shelve
+import threading
+
+# for scheduling sensor polls, on a clock that doesn't jump when the time is set
+import heapq
+from obd2_reader import monotonic
+
+# for storing sensor readings, see SensorRing
+import array
+import bisect
+import collections
+
+# for batch decoding of recorded sensor series (optional)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 #
 # See README.OBD2 for OBD2 reference info
@@ -60,6 +84,36 @@ PIDs = {}
 DTCs = {}
 #   DTCs[code] = Description
 
+# compiled PID formulas, so each formula string is only parsed once
+formulas = {}
+#   formulas[formula] = code object
+
+# PIDs and DTCs above are the merged view of stacked definition layers, later layers win:
+#   'std'   - SAE standard definitions
+#   'mfr'   - manufacturer specific definitions
+#   'fleet' - local additions & corrections
+def_layer_order = ['std', 'mfr', 'fleet']
+#   def_layers[kind][layer] = list of [csvfile, wmis]
+#      kind = 'PIDs' or 'DTCs'
+#      wmis = list of World Manufacturer IDs (first 3 chars of the VIN) the file applies to, None for all
+def_layers = {
+    'PIDs' : { 'std' : [], 'mfr' : [], 'fleet' : [] },
+    'DTCs' : { 'std' : [], 'mfr' : [], 'fleet' : [] }
+}
+#   def_files[csvfile] = parsed definitions, files are only parsed when a vehicle needs them
+def_files = {}
+#   def_merged[(kind, wmi)] = merged definitions for that manufacturer
+def_merged = {}
+# WMI of the vehicle the definitions are selected for, None until the VIN is known
+def_wmi = None
+
+# the capability cache is shared by every OBD2 object, see scan_features_cached
+cap_lock = threading.Lock()
+# the definitions above are for one vehicle at a time, see OBD2.decode
+defs_lock = threading.Lock()
+# DTCs are only merged when a description is looked up
+DTCs_stale = False
+
 
 # DTCs since last time DTCs were cleared
 GET_PERM_DTCs      = "03"
@@ -134,6 +188,14 @@ misc_diag_PIDs = [ "0130", "0131", "014E", "0121", "014D"]
 #
 
 
+# frozen copies of the lists above for fast membership tests
+feature_PIDset = frozenset(feature_PIDs)
+info_PIDset    = frozenset(info_PIDs)
+status_PIDset  = frozenset(status_PIDs)
+# PIDs that are not plain sensor readings
+nonsensor_PIDset = feature_PIDset | info_PIDset | status_PIDset
+
+
 # helper for storing info & status pid data
 pidmap = {
    "011C" : 'OBD_std',
@@ -247,28 +309,179 @@ non_continuous_monitors = [
 ]
 
 
+#
+# definition file cache
+#
+
+# parsing the CSV files every time a script starts is slow, so the parsed
+#   definitions are saved next to the CSV file in marshal format:
+#     <csvfile>.cache = { 'key' : cache_key(csvfile), 'data' : parsed definitions }
+#   the cache is rebuilt whenever the CSV file changes
+
+# bump this when the format of the cached data changes
+CACHE_VERSION = 1
+
+def cache_key(csvfile):
+    """ Identify a version of a CSV file by its path, size and mtime . """
+    st = os.stat(csvfile)
+    # marshal'd code objects are only good for the python that wrote them
+    return (CACHE_VERSION, sys.version, os.path.abspath(csvfile), st.st_size, st.st_mtime)
+
+
+def load_csv_cache(csvfile):
+    """ Return the cached definitions for a CSV file, None if missing or stale . """
+    try:
+        with open(csvfile + '.cache', 'rb') as f:
+            cache = marshal.load(f)
+        if cache['key'] == cache_key(csvfile):
+            return cache['data']
+    except Exception:
+        # no cache, unreadable cache, or cache from another python
+        pass
+    return None
+
+
+def save_csv_cache(csvfile, data):
+    """ Save the parsed definitions of a CSV file . """
+    try:
+        with open(csvfile + '.cache', 'wb') as f:
+            marshal.dump( { 'key' : cache_key(csvfile), 'data' : data }, f )
+    except (IOError, OSError):
+        # read-only location, just parse the CSV again next time
+        pass
+
+
+def compile_formula(formula):
+    """ Compile a PID formula, reusing the result for repeats . """
+    if formula not in formulas:
+        formulas[formula] = compile(formula, '<formula>', 'eval')
+    return formulas[formula]
+
+
+#
+# definition layers
+#
+
+def add_definitions(kind, csvfile, layer, wmis):
+    """ Add a definition file to a layer . """
+    def_layers[kind][layer].append( [csvfile, wmis] )
+    # any merged views of this kind are out of date now
+    for key in def_merged.keys():
+        if key[0] == kind:
+            del def_merged[key]
+
+
+def merged_definitions(kind, wmi):
+    """ Merge the definition layers that apply to a manufacturer . """
+    key = (kind, wmi)
+    if key not in def_merged:
+        merged = {}
+        for layer in def_layer_order:
+            for [csvfile, wmis] in def_layers[kind][layer]:
+                if wmis is None or wmi in wmis:
+                    if kind == 'PIDs':
+                        merged.update( parse_pids_file(csvfile) )
+                    else:
+                        merged.update( parse_dtcs_file(csvfile) )
+        def_merged[key] = merged
+    return def_merged[key]
+
+
+def select_definitions(VIN):
+    """ Use the PID & DTC definitions for the manufacturer of the given vehicle . """
+    global PIDs, DTCs_stale, def_wmi
+
+    wmi = None
+    if len(VIN) == 17:
+        wmi = str.upper(VIN[0:3])
+
+    if wmi != def_wmi:
+        def_wmi = wmi
+        PIDs = merged_definitions('PIDs', def_wmi)
+        DTCs_stale = True
+
+
 # DTC info loader
-def load_dtcs_from_csv(dtcsfile):
+def load_dtcs_from_csv(dtcsfile, layer='std', wmis=None):
     """ Load DTC definitions from CSV file . """
-    # load DTC definitions from CSV file into DTCs dict
+    global DTCs_stale
+    # the file is not read until a DTC description is actually needed,
+    #   most scans don't turn up any DTCs
+    add_definitions('DTCs', dtcsfile, layer, wmis)
+    DTCs_stale = True
+
+
+def parse_dtcs_file(dtcsfile):
+    """ Parse a DTC definition file, using the cache if it is current . """
+    if dtcsfile not in def_files:
+        dtcs = load_csv_cache(dtcsfile)
+        if dtcs is None:
+            dtcs = read_dtcs_from_csv(dtcsfile)
+            save_csv_cache(dtcsfile, dtcs)
+        def_files[dtcsfile] = dtcs
+    return def_files[dtcsfile]
+
+
+def read_dtcs_from_csv(dtcsfile):
+    """ Read DTC definitions from CSV file . """
     #
     #  DTC,"Description"
     #
+    dtcs = {}
     with open(dtcsfile, 'rb') as f:
         reader = csv.reader(f)
-        # skip the field description line
-        flddesc = reader.next()
         for row in reader:
-            DTCs[row[0]] = row[1]
+            # skip the field description line, if there is one
+            if len(row) < 2 or len(row[0]) != 5:
+                continue
+            dtcs[row[0]] = row[1]
+    return dtcs
+
+
+def dtc_description(code):
+    """ Look up the description of a DTC . """
+    global DTCs, DTCs_stale
+    # merge in any definition files that are still waiting
+    if DTCs_stale:
+        DTCs = merged_definitions('DTCs', def_wmi)
+        DTCs_stale = False
+    return DTCs.get(code, "Unknown DTC")
 
 
 # PID info loader
-def load_pids_from_csv(pidsfile):
+def load_pids_from_csv(pidsfile, layer='std', wmis=None):
     """ Load PID definitions from CSV file . """
+    global PIDs
     # load PID definitions from CSV file into PIDs dict
     #
     #  "Mode (hex)","PID (hex)","Data bytes returned",Desc,Min,Max,Units,Formula[,Desc,Min,Max,Units,Formula]*
     #
+    add_definitions('PIDs', pidsfile, layer, wmis)
+    PIDs = merged_definitions('PIDs', def_wmi)
+
+
+def parse_pids_file(pidsfile):
+    """ Parse a PID definition file, using the cache if it is current . """
+    if pidsfile not in def_files:
+        cache = load_csv_cache(pidsfile)
+        if cache is None:
+            cache = { 'PIDs' : read_pids_from_csv(pidsfile), 'formulas' : {} }
+            # compile the formulas up front too, some of them are just notes, leave those for decode time
+            for [B, sensors] in cache['PIDs'].itervalues():
+                for sensor in sensors:
+                    try:
+                        cache['formulas'][sensor[4]] = compile(sensor[4], '<formula>', 'eval')
+                    except SyntaxError:
+                        pass
+            save_csv_cache(pidsfile, cache)
+        formulas.update(cache['formulas'])
+        def_files[pidsfile] = cache['PIDs']
+    return def_files[pidsfile]
+
+
+def read_pids_from_csv(pidsfile):
+    """ Read PID definitions from CSV file . """
+    pids = {}
     with open(pidsfile, 'rb') as f:
         reader = csv.reader(f)
         # skip the field description line
@@ -296,42 +509,51 @@ def load_pids_from_csv(pidsfile):
                 sensors.append(row[j:j+5])
                 i += 1
 
-            PIDs[PID] = [B, sensors]
+            pids[PID] = [B, sensors]
+
+    return pids
 
 
 #
 # decoding helpers
 #
 
+# precomputed tables, indexed by byte value 0-255
+#   byte_bitstrings - the bits as a string, LSB first so they are array addressable
+#   byte_setbits_msb - positions of the set bits, counting from the MSB, as used by the feature bitmaps
+#   byte_setbits_lsb - positions of the set bits, counting from the LSB, as used by the O2 sensor bitmaps
+byte_bitstrings  = [ ''.join([ str((v >> j) & 1) for j in range(8) ]) for v in range(256) ]
+byte_setbits_msb = [ [ j for j in range(8) if v & (0x80 >> j) ] for v in range(256) ]
+byte_setbits_lsb = [ [ j for j in range(8) if v & (0x01 << j) ] for v in range(256) ]
+
+
 def hex_to_bitstring(str):
     """ Convert hex digits to a string of bits"""
     # 4 bits per hex digit
-    bitstring = ""
-    for i in str:
-        # silly type safety, we don't want to eval random stuff
-        if type(i) == type(''):
-            v = eval("0x%s" % i)
-            for j in (8, 4, 2, 1):
-                if v & j :
-                    bitstring += '1'
-                else:
-                    bitstring += '0'
-    # reverse the string to make it array addressable
-    return bitstring[::-1]
+    # the usual case is a single hexbyte
+    if len(str) == 2:
+        return byte_bitstrings[int(str, 16)]
+    if len(str) == 0:
+        return ''
+    v = int(str, 16)
+    # LSB first to make it array addressable
+    return ''.join([ '1' if (v >> j) & 1 else '0' for j in range(4*len(str)) ])
+
+
+# hex to ASCII translation, anything that isn't printable becomes '_'
+text_table = ''.join([ chr(c) if c >= 0x20 and c <= 0x7E else '_' for c in range(256) ])
 
 
 def decode_text( data ) :
     """ Decode ASCII text encoded in hex"""
-    TXT = ''
-    for d in data:
-         # check that result is actually ascii
-         #if d >= '20' and d <= '7E':
-         hd = eval( "0x" + d )
-         if hd >= 0x20 and hd <= 0x7E :
-             TXT += binascii.unhexlify(d)
-         else:
-             TXT += '_'
-    return TXT
+    # convert all the hexbytes at once, then filter out the non-ascii chars
+    return binascii.unhexlify( ''.join(data) ).translate( text_table )
+
+
+def decode_text_padded( data ) :
+    """ Decode ASCII text encoded in hex, without the '00' fill bytes at the end"""
+    # CALIDs shorter than 16 chars are filled out with '00'
+    return binascii.unhexlify( ''.join(data) ).rstrip('\x00').translate( text_table )
 
 
 def decode_ints( data ) :
@@ -356,10 +578,7 @@ def decode_hex( data ) :
 # used by monitor decode and O2 sensor bitmap decode
 def hexbytes_to_bitarrays( data ) :
     """ Convert list of hex bytes to a list of bitstrings """
-    bitstrs = []
-    for b in data:
-        bitstrs.append(hex_to_bitstring(b))
-    return bitstrs
+    return [ hex_to_bitstring(b) for b in data ]
 
 
 
@@ -382,6 +601,9 @@ def decode_obd2_record(obd2_record):
 
     decoded_record = {}
     decoded_record['timestamp'] = obd2_record['timestamp']
+    for k in ['sent', 'mono_sent', 'mono_recv']:
+        if k in obd2_record:
+            decoded_record[k] = obd2_record[k]
     decoded_record['command']   = obd2_record['command']
 
     decoded_record['values']    = {}
@@ -448,6 +670,57 @@ def decode_obd2_record(obd2_record):
 
 
 
+# ELM327 accepts up to 6 mode 01 PIDs in one request on CAN, ie. "010C0D05"
+max_batch_PIDs = 6
+
+# round trip time (seconds) to assume for a command before we have measured any
+default_latency = 0.1
+
+# PIDs that time out are retried after an exponential backoff (seconds),
+#   once they have failed too many times in a row they are quarantined and only probed occasionally
+backoff_first     = 1
+backoff_max       = 60
+quarantine_after  = 5
+quarantine_probe  = 300
+# reader errors that mean the vehicle didn't answer
+nodata_errors = ['NO DATA', 'NO RESPONSE', 'TIMEOUT']
+
+
+def batch_PIDs(cmd):
+    """ List the PIDs requested by a command, more than one for a batched mode 01 request . """
+    if cmd[0:2] == '01' and len(cmd) > 4:
+        return [ cmd[0:2] + cmd[i:i+2] for i in range(2, len(cmd), 2) ]
+    return [ cmd ]
+
+
+def split_multi_pid_record(obd2_record):
+    """ Split the reply to a multi-PID mode 01 request into one record per PID . """
+    # the reply from each ECU is '41', then each PID byte followed by its databytes
+    #   41 0C 1A F8 0D 32 05 7B
+    records = {}
+    for PID in batch_PIDs( obd2_record['command'] ):
+        records[PID] = { 'timestamp' : obd2_record['timestamp'],
+                         'command'   : PID,
+                         'responses' : {} }
+        for k in ['sent', 'mono_sent', 'mono_recv']:
+            if k in obd2_record:
+                records[PID][k] = obd2_record[k]
+
+    for (ECU, DATABYTES) in obd2_record['responses'].iteritems():
+        i = 1
+        while i < len(DATABYTES):
+            PID = '01' + str.upper(DATABYTES[i]).rjust(2,'0')
+            if PID not in records or PID not in PIDs or not PIDs[PID][0].isdigit():
+                # can't tell where the next PID starts
+                break
+            n = int(PIDs[PID][0])
+            records[PID]['responses'][ECU] = [ DATABYTES[0], DATABYTES[i] ] + DATABYTES[i+1:i+1+n]
+            i += 1 + n
+
+    return [ records[PID] for PID in sorted(records.keys()) ]
+
+
+
 def decode_data_by_mode(mode, pid, data):
     """ Determine which decoder to use, based on mode . """
     # expecting:
@@ -528,24 +801,20 @@ def decode_feature_pid(PID, data):
 
     L = len(data)
     #print "Fpid length:", L
-    bits = L*8
 
-    feat_bits = ""
     if L == 4 :
-        for db in data :
-            # reverse the bit order and append
-            feat_bits += hex_to_bitstring(db)[::-1]
+        # the bitmap reads MSB first
+        setbits = byte_setbits_msb
     else:
-        for db in data :
-            # O2 sensor bitmap isn't reversed ?
-            feat_bits += hex_to_bitstring(db)
-    
-    for i in range(bits):
-        if feat_bits[i] == '1':
+        # O2 sensor bitmap isn't reversed ?
+        setbits = byte_setbits_lsb
+
+    for k in range(L):
+        for j in setbits[ int(data[k], 16) ]:
+            i = 8*k + j
             # do math as integers, then convert back to hex
-            P = str.upper(hex(P0+i+1))[2:].rjust(2, "0")
-            newpid = M + P
-            #print "M:", M, " P0:", P0, " i:", i, " P:", P, "Newpid:", newpid 
+            newpid = M + "%02X" % (P0+i+1)
+            #print "M:", M, " P0:", P0, " i:", i, "Newpid:", newpid
             feat_pids.append(newpid)
 
             # not sure we want/need to do this
@@ -569,26 +838,18 @@ def decode_mode1_pid(PID, data):
         values.append( ["Unknown PID: " + PID, decode_hex(data), ""] )
         return []
 
-    elif PID in feature_PIDs:
+    elif PID in feature_PIDset:
         return decode_feature_pid(PID, data)
 
     elif PID == '0101' or PID == '0141':
         return decode_monitors(PID, data)
 
     elif PID == '0103':
-        A = hex_to_bitstring(data[0])
-        B = hex_to_bitstring(data[1])
-        # debug
-        #print "A:", A, "B:", B
-        fcode1 = -1
-        fcode2 = -1
-        i = 0 
-        while i < 5:
-            if A[i] == '1':
-                fcode1 = i
-            if B[i] == '1':
-                fcode2 = i
-            i += 1
+        A = int(data[0], 16)
+        B = int(data[1], 16)
+        # the highest of the first 5 bits that is set, -1 if none
+        fcode1 = (A & 0x1F).bit_length() - 1
+        fcode2 = (B & 0x1F).bit_length() - 1
         if fcode1 != -1:
           values.append( ["Fuel system 1 status", fcode1, fuel_system_statuses[fcode1]] )
         if fcode2 != -1:
@@ -596,13 +857,11 @@ def decode_mode1_pid(PID, data):
         return values
 
     elif PID == '0112':
-        A = hex_to_bitstring(data[0])
-        i = 0 
-        while i < 3:
-            if A[i] == '1':
-                sacode = i
-            i += 1
-        values.append( ["Secondary air status", sacode, secondary_air_statuses[sacode]] )
+        A = int(data[0], 16)
+        # the highest of the first 3 bits that is set, -1 if none
+        sacode = (A & 0x07).bit_length() - 1
+        if sacode != -1:
+          values.append( ["Secondary air status", sacode, secondary_air_statuses[sacode]] )
         return values
 
     # sort of handled above 
@@ -642,7 +901,7 @@ def decode_mode5_pid(PID, data):
         values.append( ["Unknown PID: " + PID, decode_hex(data), ""] )
         return []
 
-    elif PID in feature_PIDs:
+    elif PID in feature_PIDset:
         return decode_feature_pid(PID, data)
 
     else :
@@ -669,7 +928,7 @@ def decode_mode6_pid(PID, data):
     #    return []
     #
     #elif PID in feature_PIDs:
-    if PID in feature_PIDs:
+    if PID in feature_PIDset:
         #return []
         if len(data) == 5 :
             # pop filler byte on old style messages
@@ -690,6 +949,23 @@ def decode_mode6_pid(PID, data):
         return []
 
 
+def mode9_items( data, itemsize ) :
+    """ Split mode 09 data into items, without the message count or padding """
+    # CAN replies start with a message count (number of items), old style replies don't
+    #   0902 VIN   - 1 item of 17 bytes
+    #   0904 CALID - 1 or more items of 16 bytes each
+    #   0906 CVN   - 1 or more items of 4 bytes each
+    if len(data) % itemsize == 1:
+        data = data[1:]
+
+    # old style pads the front of the message with '00' bytes
+    pad = len(data) % itemsize
+    if pad > 0 and data[0:pad] == ['00'] * pad:
+        data = data[pad:]
+
+    return [ data[i:i+itemsize] for i in range(0, len(data), itemsize) ]
+
+
 def decode_mode9_pid(PID, data):
     """ Decode Mode9 sensor reading using PIDs dict . """
 
@@ -702,10 +978,10 @@ def decode_mode9_pid(PID, data):
         values.append( ["Unknown PID: " + PID, decode_hex(data), ""] )
         return []
 
-    elif PID in feature_PIDs:
+    elif PID in feature_PIDset:
         if len(data) == 5:
-            # pop message count
-            data.pop(0)
+            # skip message count
+            data = data[1:]
         return decode_feature_pid(PID, data)
 
     # message counts for next pids
@@ -717,34 +993,24 @@ def decode_mode9_pid(PID, data):
     elif PID == '0902':
         #   0902 should have 17 bytes
         #    VIN: XXXXXXXXXXXXXXXXX
-        if len(data) == 18:
-            # pop message count
-            data.pop(0)
-        # old style pads '0902' with 3 '00' bytes at front
-        if data[0] == '00' and data[1] == '00' and data[2] == '00':
-            data.pop(0)
-            data.pop(0)
-            data.pop(0)
-        values.append( [ PIDs[PID][1][0][0], decode_text( data ), "" ] )
+        for item in mode9_items( data, 17 ):
+            values.append( [ PIDs[PID][1][0][0], decode_text( item ), "" ] )
         return values
 
     # Calibration ID
     elif PID == '0904':
-        #  0904 should have 16 bytes
+        #  0904 should have 16 bytes per ECU calibration
         #  CALID: XXXXXXXXXXXXXXXX
-        if len(data) == 17 or len(data) == 33:
-            # pop message count
-            data.pop(0)
-        values.append( [ PIDs[PID][1][0][0], decode_text( data ), "" ] )
+        #  33 bytes is a message count and 2 CALIDs, report each of them
+        for item in mode9_items( data, 16 ):
+            values.append( [ PIDs[PID][1][0][0], decode_text_padded( item ), "" ] )
         return values
 
     elif PID == '0906':
         # 4 hex bytes
         #  CVN: XX XX XX XX
-        if len(data) == 5:
-            # pop message count
-            data.pop(0)
-        values.append( [ PIDs[PID][1][0][0], decode_hex( data ), "" ] )
+        for item in mode9_items( data, 4 ):
+            values.append( [ PIDs[PID][1][0][0], decode_hex( item ), "" ] )
         return values
 
     elif PID == '0908':
@@ -752,8 +1018,8 @@ def decode_mode9_pid(PID, data):
         #print "IPT decode...."
 
         if len(data) == 33:
-            # pop message count
-            data.pop(0)
+            # skip message count
+            data = data[1:]
 
         ipt_names = [
         "OBDCOND",
@@ -774,11 +1040,11 @@ def decode_mode9_pid(PID, data):
         "EVAPCOND",
         ]
 
-        while len(data) > 0:
-            A = 256 * int( data.pop(0), 16 )
-            B = int( data.pop(0), 16 )
+        for i in range( min(len(data) / 2, len(ipt_names)) ):
+            A = 256 * int( data[2*i], 16 )
+            B = int( data[2*i+1], 16 )
             #print "A+B", A, B, A+B
-            values.append( [ "IPT: " + ipt_names.pop(0), A+B , "" ] )
+            values.append( [ "IPT: " + ipt_names[i], A+B , "" ] )
 
         return values
 
@@ -837,7 +1103,7 @@ def decode_generic_pid(PID, data):
         # TODO: more checking to be sure that we are not eval'ing something wierd
 
         # compute and test value
-        value = eval(formula)
+        value = eval( compile_formula(formula) )
 
         if value < minval:
             values.append( [desc, "ERROR", "undermin"] )
@@ -849,13 +1115,105 @@ def decode_generic_pid(PID, data):
     return values
 
 
+def decode_generic_pid_batch(PID, datalist):
+    """ Decode many readings of one generic PID at once using numpy arrays . """
+    # datalist is a list of databyte lists, one per reading, same as the D passed to decode_generic_pid
+    #
+    # returns a list with one entry per sensor:  [desc, values, unit, errors]
+    #   values - array of floats, NaN where the reading could not be decoded
+    #   errors - dict of boolean arrays:  'short', 'undermin', 'overmax', 'formula' (no formula to decode with)
+    #
+    # the formula from the CSV file is evaluated once over whole arrays of A, B, C, ...
+    # instead of once per reading, which is what makes long traces cheap to decode
+
+    if numpy is None:
+        raise ImportError("numpy is required for batch decoding")
+
+    values = []
+
+    # skip unknown pids
+    if PID not in PIDs:
+        return []
+
+    databytes   = int(PIDs[PID][0])
+    N           = len(datalist)
+
+    # readings with too few databytes can't be decoded, flag them and leave their row zeroed
+    short = numpy.array([ len(data) < databytes for data in datalist ], dtype=bool)
+    raw   = numpy.zeros( (N, databytes), dtype=numpy.int64 )
+
+    if databytes > 0 and not short.all():
+        # convert all the hexbytes in one pass
+        hexstr = ''.join( [ ''.join(data[:databytes]) for data in datalist if len(data) >= databytes ] )
+        good = numpy.frombuffer( binascii.unhexlify(hexstr), dtype=numpy.uint8 )
+        raw[~short] = good.reshape(-1, databytes)
+
+    # assign A, B, C, D, ... as columns
+    regs = {}
+    for i in range(min(databytes, 7)):
+        regs["ABCDEFG"[i]] = raw[:, i]
+
+    # some PIDs have info for multiple sensors
+    for sensor in PIDs[PID][1] :
+        desc    = sensor[0]
+        unit    = sensor[3]
+        formula = sensor[4]
+
+        errors = {}
+        errors['short']    = short
+        errors['formula']  = numpy.zeros(N, dtype=bool)
+
+        # compute and test values, constant formulas get broadcast to every reading
+        value = None
+        if len(formula) > 0:
+            value = numpy.asarray( eval(compile_formula(formula), {}, regs), dtype=numpy.float64 ) * numpy.ones(N)
+
+        # no formula, or not one that works on arrays: the same shape, nothing decoded
+        if value is None or value.ndim != 1:
+            value = numpy.empty(N)
+            value.fill(numpy.nan)
+            errors['formula']  = numpy.ones(N, dtype=bool)
+            errors['undermin'] = numpy.zeros(N, dtype=bool)
+            errors['overmax']  = numpy.zeros(N, dtype=bool)
+            values.append( [desc, value, unit, errors] )
+            continue
+
+        # PIDs without a formula have no limits either
+        minval  = float(sensor[1])
+        maxval  = float(sensor[2])
+        errors['undermin'] = (value < minval) & ~short
+        errors['overmax']  = (value > maxval) & ~short
+
+        value[ short | errors['undermin'] | errors['overmax'] ] = numpy.nan
+        values.append( [desc, value, unit, errors] )
+
+    return values
+
+
+# monitor status rarely changes between polls, so remember the decoded result for each payload
+#   monitor_cache[(PID, payload)] = values
+monitor_cache = {}
+monitor_cache_max = 1024
+
+
 def decode_monitors( PID, data ) :
     """ Decode onboard emmissions monitors """
     # this is the primary OBD info considered by the Official Emmissions Inspection process
     # 0101 looks at the overall status of the monitors, 
     # 0141 looks at the their status only for the current drive cycle
+    key = (PID, ''.join(data))
+    if key not in monitor_cache:
+        if len(monitor_cache) >= monitor_cache_max:
+            monitor_cache.clear()
+        monitor_cache[key] = decode_monitor_bits( PID, data )
+    # hand out copies, callers are free to modify them
+    return [ list(v) for v in monitor_cache[key] ]
+
+
+def decode_monitor_bits( PID, data ) :
+    """ Decode the 4 monitor status bytes of 0101/0141 """
     values = []
-    [A, B, C, D] = hexbytes_to_bitarrays( data )
+    [A, B, C, D] = [ int(b, 16) for b in data ]
  
     badtxt = "INCOMPLETE"
 
@@ -865,47 +1223,42 @@ def decode_monitors( PID, data ) :
         # debug
         #print "Monitor status OVERALL"
         MIL = "Off"
-        if A[7] == '1':
+        if A & 0x80:
             MIL = "ON"
         values.append( ["MIL", MIL, ""] )
-        DTC_CNT = int(data[0], 16) & int(0x7F)
+        DTC_CNT = A & 0x7F
         values.append( ["DTC count", DTC_CNT, ""] )
     else:
         # debug
         #print "Monitor status THIS DRIVE CYCLE"
         pass
 
-    ign = int(B[3])
+    ign = (B >> 3) & 1
     values.append( [ "Ignition Type", ign, ignition_type[ign] ] )
 
     # TODO: these should just skip unsupported sensors, duh.
     #   and doneness should be the 2nd field in the 3 tuple
     for i in [0, 1, 2]:
         done = badtxt
-        if B[i] == '1':
-            if B[i+4] == '0':
+        if (B >> i) & 1:
+            if not (B >> (i+4)) & 1:
                 done = "OK"
             values.append( ['Continuous Monitor', continuous_monitors[i], done] )
 
     # C lists supported monitors (1 = SUPPORTED)
     # D lists their readiness (0 = READY)
     if ign == 0 :
-        for i in [0, 1, 2, 3, 4, 5, 6, 7]:
-            done = badtxt
-            if C[i] == '1':
-                if D[i] == '0':
-                    done = "OK"
-                # debug
-                #print 'Monitor', non_continuous_monitors[0][i], done
-                values.append( ['Non-continuous Monitor', non_continuous_monitors[0][i], done] )
-
-    if ign == 1 :
-        for i in [0, 1, 3, 5, 6, 7]:
-            done = badtxt
-            if C[i] == '1':
-                if D[i] == '0':
-                    done = "OK"
-                values.append( ['Non-continuous Monitor', non_continuous_monitors[1][i], done] )
+        monitors = [0, 1, 2, 3, 4, 5, 6, 7]
+    else :
+        monitors = [0, 1, 3, 5, 6, 7]
+    for i in monitors:
+        done = badtxt
+        if (C >> i) & 1:
+            if not (D >> i) & 1:
+                done = "OK"
+            # debug
+            #print 'Monitor', non_continuous_monitors[ign][i], done
+            values.append( ['Non-continuous Monitor', non_continuous_monitors[ign][i], done] )
 
 
     # debug
@@ -913,30 +1266,598 @@ def decode_monitors( PID, data ) :
     return values
 
 
+# first letter of the DTC, indexed by the top 2 bits of the first byte
+dtc_charcode = [ "P", "C", "B", "U" ]
+
+
 def decode_DTCs( data ) :
     """ Decode Diagnostic Trouble Codes """
     values = []
 
-    charcode = [ "P", "C", "B", "U" ]
+    # CAN replies start with a count of DTCs, skip it
+    start = len(data) % 2
 
-    if len(data) % 2 == 1:
-        numDTCs = data.pop(0)
-    
-    while len(data) > 1:
-        A = data.pop(0)
-        B = data.pop(0)
+    for i in range(start, len(data) - 1, 2):
+        A = int(data[i], 16)
+        B = int(data[i+1], 16)
  
-        # 00 00 is padding
-        if A != '00' and B != '00':
-            A0 = int(A[0], 16)
-            DTC = str(charcode[ A0 / 4 ]) + str(A0 % 4) + A[1] + B
-            values.append( [ "DTC", DTC, DTCs[DTC] ] )
+        # 00 00 is padding, but a single 00 byte is valid, ie. P0100 is 01 00
+        if A == 0 and B == 0:
+            continue
+
+        DTC = "%s%d%X%02X" % ( dtc_charcode[A >> 6], (A >> 4) & 3, A & 0x0F, B )
+        values.append( [ "DTC", DTC, dtc_description(DTC) ] )
 
     return values
 
 
 
 
+class SupportedPIDs:
+    """ Set of PIDs supported by a vehicle, kept as one 256-bit bitmap per mode."""
+    def __init__(self, pids=[]):
+        """Start with the given PIDs. """
+        #   self.bitmaps[mode] = int, bit N set if PID N of that mode is supported
+        self.bitmaps = {}
+        # anything that doesn't fit the MMPP format, ie. mode only "03"
+        self.others  = set()
+        for pid in pids:
+            self.add(pid)
+
+    def add(self, pid):
+        """ Mark a PID as supported. """
+        if len(pid) == 4:
+            M = int(pid[0:2], 16)
+            self.bitmaps[M] = self.bitmaps.get(M, 0) | (1 << int(pid[2:4], 16))
+        else:
+            self.others.add(pid)
+
+    def __contains__(self, pid):
+        if len(pid) == 4:
+            return (self.bitmaps.get(int(pid[0:2], 16), 0) >> int(pid[2:4], 16)) & 1 == 1
+        return pid in self.others
+
+    def mode_pids(self, M):
+        """ List the supported PIDs of one mode, in order. """
+        bitmap = self.bitmaps.get(M, 0)
+        return [ "%02X%02X" % (M, P) for P in range(256) if (bitmap >> P) & 1 ]
+
+    def list(self):
+        """ List all supported PIDs, in order. """
+        pids = []
+        for M in sorted(self.bitmaps.keys()):
+            pids.extend( self.mode_pids(M) )
+        return sorted(self.others) + pids
+
+    def __iter__(self):
+        return iter(self.list())
+
+    def __len__(self):
+        return len(self.list())
+
+    def __repr__(self):
+        return repr(self.list())
+
+
+
+
+# samples kept per sensor, a day of readings at 20 per second (~27 MB at most),
+#   the arrays only grow as samples come in
+ring_capacity = 86400 * 20
+# readings kept of PIDs that aren't sensors (status, DTCs, info ...)
+snapshot_hist = 100
+# summaries of each sensor over back to back windows, see Rollup
+#   window width (seconds) : number of windows kept
+rollup_windows = { 1 : 3600, 60 : 7 * 1440 }
+# seconds to keep raw samples for, None keeps them until the ring is full,
+#   the rollups and running stats still cover everything
+raw_retention = None
+# sensors that only store a sample when it moves past a tolerance from the last one stored,
+#   PID or sensor name : tolerance in the sensor's units, 0 stores changes only
+#   PIDs that aren't sensors (status, info ...) store a reply only when it changes
+#   the running stats & rollups still see every sample
+deadbands = { '0105' : 1, '010F' : 1, '0146' : 1, '0133' : 1, '012F' : 1,
+              '0101' : 0, '011C' : 0, '0151' : 0 }
+# seconds between stored samples of a reading that isn't changing (keyframes),
+#   so a query can tell a steady reading from one that stopped coming
+keyframe_interval = 60
+
+
+def deadband_of(pid, sensor=None):
+    """ Tolerance of a sensor (or PID) from deadbands, None stores every sample. """
+    if sensor in deadbands:
+        return deadbands[sensor]
+    return deadbands.get(pid)
+
+
+class SensorRing:
+    """ Readings of one sensor, a fixed capacity ring buffer of float64 times and values."""
+    def __init__(self, unit='', capacity=None, deadband=None):
+        """Empty, holding up to capacity samples, or only the changes past deadband. """
+        if capacity is None:
+            capacity = ring_capacity
+        self.capacity = capacity
+        self.times    = array.array('d')
+        self.values   = array.array('d')
+        # once full, the oldest sample is at head and the newest just before it
+        self.head     = 0
+        self.unit     = unit
+        # with a deadband a stored sample stands for itself and the ones after it that weren't stored,
+        #   counts has how many, held is [time, value] of the newest one not stored
+        self.deadband = deadband
+        self.counts   = None
+        if deadband is not None:
+            self.counts = array.array('d')
+        self.held     = None
+        # sensors that read as text, ie. "Open loop", keep the index into text as the value
+        self.is_text  = None
+        self.text     = []
+        self.text_codes = {}
+        # running aggregates of every numeric sample ever added (Welford), see stats
+        self.count    = 0
+        self.mean     = 0.0
+        self.m2       = 0.0
+        self.min      = None
+        self.max      = None
+
+    def append(self, t, value, unit=None):
+        """ Add a sample, the oldest one goes once full.  Times are expected in order. """
+        # a reading that didn't decode ([desc, "ERROR", "overmax"] ...) goes in as NaN,
+        #   the "unit" is the reason, not a unit
+        if value == "ERROR":
+            value = float('nan')
+        elif unit is not None:
+            self.unit = unit
+        if self.is_text is None and value == value:
+            self.is_text = not isinstance(value, (int, long, float))
+        if value != value:
+            v = float('nan')
+        elif self.is_text:
+            value = str(value)
+            if value not in self.text_codes:
+                self.text_codes[value] = len(self.text)
+                self.text.append(value)
+            v = self.text_codes[value]
+        elif isinstance(value, (int, long, float)):
+            v = value
+            if v == v:
+                self.count += 1
+                delta = v - self.mean
+                self.mean += delta / self.count
+                self.m2   += delta * (v - self.mean)
+                if self.min is None or v < self.min:
+                    self.min = v
+                if self.max is None or v > self.max:
+                    self.max = v
+        else:
+            v = float('nan')
+
+        if self.deadband is not None and len(self.times) > 0:
+            i = self.newest()
+            last = self.values[i]
+            # text only matches itself, NaN never does
+            if t - self.times[i] < keyframe_interval and \
+               (v == last or (not self.is_text and abs(v - last) <= self.deadband)):
+                self.counts[i] += 1
+                self.held = [t, v]
+                return
+            self.held = None
+
+        if len(self.times) < self.capacity:
+            self.times.append(t)
+            self.values.append(v)
+            if self.counts is not None:
+                self.counts.append(1)
+        else:
+            self.times[self.head]  = t
+            self.values[self.head] = v
+            if self.counts is not None:
+                self.counts[self.head] = 1
+            self.head = (self.head + 1) % self.capacity
+
+    def __len__(self):
+        return len(self.times)
+
+    def newest(self):
+        """ Index of the newest stored sample. """
+        i = self.head - 1
+        if i < 0:
+            i = len(self.times) - 1
+        return i
+
+    def value(self, v):
+        """ The reading stored as v. """
+        if self.is_text:
+            if v != v:
+                return None
+            return self.text[int(v)]
+        return v
+
+    def latest(self):
+        """ [time, value] of the newest sample, None if there are none. """
+        if self.held is not None:
+            return [ self.held[0], self.value(self.held[1]) ]
+        if len(self.times) == 0:
+            return None
+        i = self.newest()
+        return [ self.times[i], self.value(self.values[i]) ]
+
+    def at(self, t):
+        """ Index of the stored sample holding at time t (the newest at or before it), None if there isn't one. """
+        # the newer run first
+        n = len(self.times)
+        for [lo, hi] in [ [0, self.head], [self.head, n] ]:
+            if lo < hi:
+                i = bisect.bisect_right(self.times, t, lo, hi)
+                if i > lo:
+                    return i - 1
+        return None
+
+    def spans(self, t0, t1):
+        """ Index ranges [a, b) of the samples with t0 <= time < t1, oldest first. """
+        # the ring is two runs of sorted times, bisect each
+        n = len(self.times)
+        spans = []
+        for [lo, hi] in [ [self.head, n], [0, self.head] ]:
+            if lo < hi:
+                a = bisect.bisect_left(self.times, t0, lo, hi)
+                b = bisect.bisect_left(self.times, t1, lo, hi)
+                if a < b:
+                    spans.append( [a, b] )
+        return spans
+
+    def columns(self, t0, t1):
+        """ [times, values, counts] of the stored samples with t0 <= time < t1, numpy arrays if numpy is there.
+             counts is None without a deadband. """
+        spans = self.spans(t0, t1)
+        result = []
+        for col in [self.times, self.values, self.counts]:
+            if col is None:
+                result.append(None)
+            elif numpy is not None:
+                C = numpy.frombuffer(col, dtype=numpy.float64)
+                # always copies, the arrays may move when they grow
+                result.append( numpy.concatenate( [ C[a:b] for [a, b] in spans ] + [ numpy.zeros(0) ] ) )
+            else:
+                c = array.array('d')
+                for [a, b] in spans:
+                    c.extend( col[a:b] )
+                result.append(c)
+        return result
+
+    def slice(self, t0, t1):
+        """ [times, values] of the samples with t0 <= time < t1, numpy arrays if numpy is there. """
+        [times, values] = self.columns(t0, t1)[0:2]
+        if self.deadband is not None:
+            # only the changes are stored, make it a whole step series:
+            #   the value held at t0 to start, and the newest sample to end
+            first = []
+            last  = []
+            i = self.at(t0)
+            if i is not None and self.times[i] < t0 and t0 <= self.latest()[0]:
+                first = [ [t0, self.values[i]] ]
+            if self.held is not None and t0 <= self.held[0] < t1:
+                last = [ self.held ]
+            if first != [] or last != []:
+                if numpy is not None:
+                    times  = numpy.concatenate( [ [ s[0] for s in first ], times,  [ s[0] for s in last ] ] )
+                    values = numpy.concatenate( [ [ s[1] for s in first ], values, [ s[1] for s in last ] ] )
+                else:
+                    times  = array.array('d', [ s[0] for s in first ]) + times  + array.array('d', [ s[0] for s in last ])
+                    values = array.array('d', [ s[1] for s in first ]) + values + array.array('d', [ s[1] for s in last ])
+        if self.is_text:
+            values = [ self.value(v) for v in values ]
+        return [times, values]
+
+    def resample(self, t0, t1, step):
+        """ [times, values] every step seconds from t0 up to t1, the value held at each time.
+             NaN (None for text) where there is no reading. """
+        # the steps of slice, looked up at each time
+        [times, values] = self.slice(t0, t1)
+        newest = self.latest()
+        if numpy is not None:
+            grid = numpy.arange(t0, t1, step)
+            if self.is_text:
+                values = numpy.array( [ self.text_codes.get(v, numpy.nan) for v in values ], dtype=numpy.float64 )
+            i = numpy.searchsorted(times, grid, 'right') - 1
+            result = numpy.where( i >= 0, values[ numpy.maximum(i, 0) ] if len(values) > 0 else numpy.nan, numpy.nan )
+            if newest is not None:
+                result[ grid > newest[0] ] = numpy.nan
+        else:
+            grid = array.array('d')
+            t = t0
+            while t < t1:
+                grid.append(t)
+                t += step
+            result = array.array('d')
+            for t in grid:
+                i = bisect.bisect_right(times, t) - 1
+                if i < 0 or t > newest[0]:
+                    result.append( float('nan') )
+                elif self.is_text:
+                    result.append( self.text_codes.get( values[i], float('nan') ) )
+                else:
+                    result.append( values[i] )
+        if self.is_text:
+            result = [ self.value(v) if v == v else None for v in result ]
+        return [grid, result]
+
+    def expire(self, t0):
+        """ Drop the samples older than t0, the newest one always stays. """
+        # copies what is left, SensorStore only calls this every so often
+        if len(self.times) == 0:
+            return
+        # a sensor that stopped reporting still has a latest reading
+        t0 = min( t0, self.times[ self.newest() ] )
+        if self.deadband is not None:
+            # the sample holding at t0 stays, it is the value from t0 on
+            i = self.at(t0)
+            if i is not None:
+                t0 = self.times[i]
+        spans = self.spans(t0, float('inf'))
+        if sum( [ b - a for [a, b] in spans ] ) == len(self.times):
+            return
+        cols = []
+        for col in [self.times, self.values, self.counts]:
+            if col is None:
+                cols.append(None)
+                continue
+            c = array.array('d')
+            for [a, b] in spans:
+                c.extend( col[a:b] )
+            cols.append(c)
+        [self.times, self.values, self.counts] = cols
+        self.head   = 0
+
+    def stats(self, t0=None, t1=None):
+        """ { count, mean, std, min, max, unit } of the samples with t0 <= time < t1, or of every sample ever. """
+        # all time is kept up as samples come in, a time range is worked out from the ring,
+        #   with a deadband each stored sample counts for the ones it stands for
+        if self.is_text:
+            return None
+        if t0 is None:
+            [n, mean, m2, lo, hi] = [self.count, self.mean, self.m2, self.min, self.max]
+        else:
+            [times, values, counts] = self.columns(t0, t1)
+            if numpy is not None:
+                if counts is None:
+                    counts = numpy.ones(len(values))
+                keep   = ~numpy.isnan(values)
+                values = values[keep]
+                counts = counts[keep]
+                n = int(counts.sum())
+                if n > 0:
+                    mean = float( (values * counts).sum() ) / n
+                    m2   = float( (counts * (values - mean) ** 2).sum() )
+                    [lo, hi] = [ float(values.min()), float(values.max()) ]
+            else:
+                if counts is None:
+                    counts = [1] * len(values)
+                pairs = [ [v, c] for [v, c] in zip(values, counts) if v == v ]
+                n = int( sum( [ c for [v, c] in pairs ] ) )
+                if n > 0:
+                    mean = sum( [ v * c for [v, c] in pairs ] ) / n
+                    m2 = sum( [ c * (v - mean) ** 2 for [v, c] in pairs ] )
+                    [lo, hi] = [ min( [ v for [v, c] in pairs ] ), max( [ v for [v, c] in pairs ] ) ]
+        if n == 0:
+            return { 'count' : 0, 'mean' : None, 'std' : None, 'min' : None, 'max' : None, 'unit' : self.unit }
+        return { 'count' : n, 'mean' : mean, 'std' : (m2 / n) ** 0.5, 'min' : lo, 'max' : hi, 'unit' : self.unit }
+
+
+
+class SensorStore:
+    """ Every reading taken from a vehicle, a SensorRing per ECU, PID & sensor."""
+    def __init__(self, capacity=None, windows=None, retention=None):
+        """Empty. Defaults are ring_capacity, rollup_windows & raw_retention. """
+        self.capacity = capacity
+        if windows is None:
+            windows = rollup_windows
+        if retention is None:
+            retention = raw_retention
+        self.windows   = windows
+        self.retention = retention
+        # self.rollups[ecu][pid][sensor][width] = Rollup
+        self.rollups   = {}
+        # when to drop the raw samples past retention next, see expire
+        self.next_expiry = None
+        # self.rings[ecu][pid][sensor] = SensorRing
+        self.rings     = {}
+        # sensor names in the order the PID reports them
+        self.sensors   = {}
+        # PIDs that aren't sensor readings keep their last few decoded values whole,
+        #   self.snapshots[ecu][pid] = deque of [time, values]
+        self.snapshots = {}
+        # round trip of each request, self.latency[pid] = SensorRing of seconds
+        self.latency   = {}
+        # newest reply of each PID from each ECU, self.last[pid][ecu] = [time, values]
+        self.last      = {}
+        # wall-clock time of monotonic time 0, see time_of
+        self.epoch     = None
+
+    def time_of(self, rec):
+        """ When the reply to a decoded record came in, as a float that never goes backwards. """
+        # wall-clock time of the first reply, plus monotonic time since,
+        #   so the clock being set doesn't scramble the order of the rings
+        if 'mono_recv' not in rec:
+            return float(rec['timestamp'])
+        if self.epoch is None:
+            self.epoch = float(rec['timestamp']) - rec['mono_recv']
+        t = self.epoch + rec['mono_recv']
+        if 'mono_sent' in rec:
+            pid = rec['command']
+            if pid not in self.latency:
+                self.latency[pid] = SensorRing('s', self.capacity)
+            self.latency[pid].append( t, rec['mono_recv'] - rec['mono_sent'] )
+        return t
+
+    def add(self, ecu, pid, t, values):
+        """ Store the decoded values of one reply. """
+        if not is_sensor_pid(pid):
+            self.set_last(ecu, pid, t, values)
+            if ecu not in self.snapshots:
+                self.snapshots[ecu] = {}
+            if pid not in self.snapshots[ecu]:
+                self.snapshots[ecu][pid] = collections.deque(maxlen=snapshot_hist)
+            snaps = self.snapshots[ecu][pid]
+            # the same reply again is only kept now and then, see deadbands
+            if deadband_of(pid) is not None and len(snaps) > 0 and snaps[-1][1] == values \
+               and t - snaps[-1][0] < keyframe_interval:
+                return
+            snaps.append( [t, values] )
+            return
+
+        # nothing to keep from an empty reply
+        values = [ val for val in values if len(val) == 3 ]
+        if values == []:
+            return
+
+        if ecu not in self.rings:
+            self.rings[ecu]   = {}
+            self.sensors[ecu] = {}
+            self.rollups[ecu] = {}
+        if pid not in self.rings[ecu]:
+            self.rings[ecu][pid]   = {}
+            self.sensors[ecu][pid] = []
+            self.rollups[ecu][pid] = {}
+        rings = self.rings[ecu][pid]
+        rollups = self.rollups[ecu][pid]
+        seen = {}
+        named = []
+        for val in values:
+            # a PID can report the same thing more than once, ie. two O2 sensors
+            sensor = val[0]
+            seen[sensor] = seen.get(sensor, 0) + 1
+            if seen[sensor] > 1:
+                sensor = "%s #%d" % (sensor, seen[sensor])
+            if sensor not in rings:
+                unit = val[2]
+                if val[1] == "ERROR":
+                    unit = ''
+                rings[sensor] = SensorRing(unit, self.capacity, deadband_of(pid, val[0]))
+                self.sensors[ecu][pid].append(sensor)
+                rollups[sensor] = {}
+                for width in self.windows:
+                    rollups[sensor][width] = Rollup(width, self.windows[width])
+            rings[sensor].append(t, val[1], val[2])
+            named.append( [sensor, val[1], val[2]] )
+            # text readings have nothing to add up
+            if not rings[sensor].is_text and isinstance(val[1], (int, long, float)):
+                for width in rollups[sensor]:
+                    rollups[sensor][width].add(t, val[1])
+        self.set_last(ecu, pid, t, named)
+
+        if self.retention is not None:
+            if self.next_expiry is None:
+                self.next_expiry = t + self.retention
+            elif t >= self.next_expiry:
+                self.expire(t - self.retention)
+                # every sample gets copied a few times at most before it goes
+                self.next_expiry = t + self.retention / 8.0
+
+    def expire(self, t0):
+        """ Drop the raw samples older than t0, the rollups keep their summaries. """
+        for ecu in self.rings:
+            for pid in self.rings[ecu]:
+                for ring in self.rings[ecu][pid].values():
+                    ring.expire(t0)
+        for ring in self.latency.values():
+            ring.expire(t0)
+
+    def set_last(self, ecu, pid, t, values):
+        if pid not in self.last:
+            self.last[pid] = {}
+        self.last[pid][ecu] = [t, values]
+
+    def ecus(self, pid):
+        """ ECUs with readings of pid. """
+        return sorted( self.last.get(pid, {}).keys() )
+
+    def latest_values(self, ecu, pid):
+        """ [time, values] of the newest reading of pid, values as [desc, value, unit], None if none. """
+        return self.last.get(pid, {}).get(ecu)
+
+    def as_dict(self):
+        """ Summary for display, ECU -> PID -> sensor -> [samples, latest time, latest value, unit]. """
+        d = {}
+        for ecu in self.rings:
+            d[ecu] = {}
+            for pid in self.rings[ecu]:
+                d[ecu][pid] = {}
+                for sensor in self.sensors[ecu][pid]:
+                    ring = self.rings[ecu][pid][sensor]
+                    d[ecu][pid][sensor] = [ len(ring) ] + ring.latest() + [ ring.unit ]
+        for ecu in self.snapshots:
+            if ecu not in d:
+                d[ecu] = {}
+            for pid in self.snapshots[ecu]:
+                d[ecu][pid] = self.last[pid][ecu]
+        return d
+
+
+class Rollup:
+    """ Count, mean, min & max of a sensor over back to back windows of one width."""
+    def __init__(self, width, capacity):
+        """Empty, keeping up to capacity windows. """
+        self.width   = width
+        # one ring per column, keyed on the start of the window
+        self.columns = {}
+        for c in ['count', 'mean', 'min', 'max']:
+            self.columns[c] = SensorRing('', capacity)
+        # the window still filling up: [start, count, sum, min, max]
+        self.current = None
+
+    def add(self, t, v):
+        """ Count a sample in.  Times are expected in order. """
+        if v != v:
+            return
+        start = t - (t % self.width)
+        cur = self.current
+        if cur is None or start != cur[0]:
+            self.close()
+            cur = self.current = [start, 0, 0.0, v, v]
+        cur[1] += 1
+        cur[2] += v
+        if v < cur[3]:
+            cur[3] = v
+        if v > cur[4]:
+            cur[4] = v
+
+    def close(self):
+        """ Move the current window into the rings. """
+        cur = self.current
+        if cur is None:
+            return
+        [start, n, total, lo, hi] = cur
+        self.columns['count'].append(start, n)
+        self.columns['mean'].append(start, total / n)
+        self.columns['min'].append(start, lo)
+        self.columns['max'].append(start, hi)
+        self.current = None
+
+    def windows(self, t0, t1):
+        """ { start, count, mean, min, max } of the windows starting at t0 <= start < t1, the current one too. """
+        result = {}
+        for c in self.columns:
+            [result['start'], result[c]] = self.columns[c].slice(t0, t1)
+        cur = self.current
+        if cur is not None and t0 <= cur[0] < t1:
+            extra = { 'start' : cur[0], 'count' : cur[1], 'mean' : cur[2] / cur[1], 'min' : cur[3], 'max' : cur[4] }
+            for c in result:
+                if numpy is not None:
+                    result[c] = numpy.append( result[c], extra[c] )
+                else:
+                    result[c].append( extra[c] )
+        return result
+
+
+
+def is_sensor_pid(pid):
+    """ Is this a PID of sensor readings (mode 01 & 02), as opposed to status, DTCs, info ... """
+    return len(pid) == 4 and pid[0:2] in ['01', '02'] and ('01' + pid[2:4]) not in nonsensor_PIDset
+
+
+
+
 # TODO - rename this OBD2_vehicle, maybe split into a separate file 
 class OBD2:
     """ OBD2 abstracts communication with OBD-II vehicle."""
@@ -946,7 +1867,7 @@ class OBD2:
         self.reader = reader
 
         # PIDs supported by any ECU in this instance, preloaded with a few to start
-        self.suppPIDs = supported_PIDs
+        self.suppPIDs = SupportedPIDs(supported_PIDs)
 
         # Dict of Basic info about the vehicle, VIN, fuel type, OBD standard, etc.
         # info is PER ECU, main engine controller is not necessarily 
@@ -983,9 +1904,25 @@ class OBD2:
                      }
         }
  
-        # BIG data structure to store all scan info
-        # self.sensor_readings --> ECU --> PID--> scantime--> list of values
-        self.sensor_readings = { }
+        # BIG data structure to store all scan info, see SensorStore
+        # self.sensor_readings --> ECU --> PID --> sensor --> SensorRing of [time, value]
+        self.sensor_readings = SensorStore()
+
+        # number of feature PIDs each ECU answered during discovery
+        self.ecu_responses = { }
+
+        # sensor polling schedule, see set_poll_rate() and poll()
+        #   self.poll_sched[pid] = { 'rate', 'priority', 'next', 'count', 'start', 'last' }
+        self.poll_sched = { }
+        # earliest deadline first:  heap of [deadline, -priority, pid]
+        self.poll_queue = [ ]
+
+        # PIDs the vehicle has stopped answering, see pid_failed()
+        #   self.pid_failures[pid] = { 'fails', 'retry', 'quarantined', 'error' }
+        self.pid_failures = { }
+
+        # VIN the PID & DTC definitions are picked by, see decode()
+        self.def_VIN = ""
 
         # TODO: something about freeze frame...
 
@@ -995,8 +1932,101 @@ class OBD2:
         # scans known feature PIDs, adds PIDs reported as supported to self.suppPIDs
         for fpid in feature_PIDs:
             if fpid in self.suppPIDs:
-                supp_pids = decode_obd2_record( self.reader.OBD2_cmd(fpid) )
+                supp_pids = self.decode( self.reader.OBD2_cmd(fpid) )
                 self.store_info( supp_pids )
+                for ecu in supp_pids['values'].iterkeys():
+                    self.ecu_responses[ecu] = self.ecu_responses.get(ecu, 0) + 1
+
+
+    def scan_features_cached(self, capfile):
+        """ Scan vehicle for supported features, unless they are already known for this vehicle. """
+        # capfile is a shelve db of capabilities from earlier scans, keyed on "VIN/CALID"
+        #   caps[key] = { 'suppPIDs', 'ECUs', 'ProtoNum', 'ecu_responses' }
+        # a known vehicle costs 2 requests (VIN & CALID) instead of a full feature scan
+        # returns True if the cached capabilities were used
+        for pid in ["0902", "0904"]:
+            self.store_info( self.decode( self.reader.OBD2_cmd(pid) ) )
+
+        key = self.vehicle_key()
+        cached = None
+        if key is not None:
+            cap_lock.acquire()
+            try:
+                caps = shelve.open(capfile)
+                try:
+                    if key in caps:
+                        cached = caps[key]
+                finally:
+                    caps.close()
+            finally:
+                cap_lock.release()
+
+        if cached is not None and cached['ProtoNum'] == self.reader_protocol():
+            self.restore_capabilities( cached )
+            return True
+
+        # the scan talks to the vehicle, don't hold up the others while it does
+        self.scan_features()
+        if key is not None:
+            cap_lock.acquire()
+            try:
+                caps = shelve.open(capfile)
+                try:
+                    caps[key] = self.capabilities()
+                finally:
+                    caps.close()
+            finally:
+                cap_lock.release()
+        return False
+
+
+    def vehicle_key(self):
+        """ Identify the vehicle by VIN and calibration ID, None if the VIN is not known. """
+        for ecu in sorted(self.info.keys()):
+            VIN = self.info[ecu].get('VIN', "Unknown")
+            if VIN != "Unknown":
+                return VIN + "/" + self.info[ecu].get('Calibration', "Unknown")
+        return None
+
+
+    def reader_protocol(self):
+        """ The protocol number the reader is using, without the 'A' for automatic. """
+        pnum = self.reader.attr.get('ProtoNum', "Unknown")
+        if pnum == "Unknown":
+            return None
+        return pnum[-1]
+
+
+    def capabilities(self):
+        """ Summarize what was discovered about the vehicle, for the capability cache. """
+        return {
+            'suppPIDs'      : self.suppPIDs.list(),
+            'ECUs'          : sorted(self.ecu_responses.keys()),
+            'ProtoNum'      : self.reader_protocol(),
+            'ecu_responses' : dict(self.ecu_responses)
+        }
+
+
+    def restore_capabilities(self, caps):
+        """ Restore capabilities saved by an earlier scan of this vehicle. """
+        for spid in caps['suppPIDs']:
+            self.suppPIDs.add(spid)
+        self.ecu_responses.update( caps['ecu_responses'] )
+        for ecu in caps['ECUs']:
+            if ecu not in self.info:
+                self.info[ecu] = {}
+            if ecu not in self.obd2status:
+                self.obd2status[ecu] = {}
+                self.obd2status[ecu]['inspmons'] = []
+                self.obd2status[ecu]['cyclemons'] = []
+
+
+    def have_info(self, pid):
+        """ Check whether an info PID has already been read from any ECU. """
+        for ecu in self.info:
+            if self.info[ecu].get( pidmap[pid], "Unknown" ) not in ["Unknown", "00"]:
+                return True
+        return False
 
 
     def scan_basic_info(self):
@@ -1004,8 +2034,9 @@ class OBD2:
         # no output, just adds to self.info
 
         for pid in info_PIDs:
-            if pid in self.suppPIDs:
-                rec = decode_obd2_record( self.reader.OBD2_cmd(pid) )
+            # VIN & CALID may already be known from scan_features_cached
+            if pid in self.suppPIDs and not self.have_info(pid):
+                rec = self.decode( self.reader.OBD2_cmd(pid) )
                 #print "Decoded: ",
                 #pprint.pprint(rec)
                 self.store_info(rec)
@@ -1034,7 +2065,7 @@ class OBD2:
    
         for pid in status_PIDs:
             if pid in self.suppPIDs:
-                rec = decode_obd2_record( self.reader.OBD2_cmd(pid) )
+                rec = self.decode( self.reader.OBD2_cmd(pid) )
                 #print "Decoded: ",
                 #pprint.pprint(rec)
                 self.store_info(rec)
@@ -1044,20 +2075,18 @@ class OBD2:
         """Take a decoded record and store the relevant info in the OBD2 vehicle object."""
      
         pid = rec['command']
-        ts = rec['timestamp']
+        ts = self.sensor_readings.time_of(rec)
 
         for ecu in rec['values'].iterkeys():
             if ecu not in self.info:
                 #print "New ECU"
                 self.info[ecu] = {}
 
-            if pid in feature_PIDs:
+            if pid in feature_PIDset:
                 #if rec['values'][ecu] == []:
                 #    self.suppPIDs.remove(pid)
                 for fpid in rec['values'][ecu]:
-                    if fpid not in self.suppPIDs :
-                        self.suppPIDs.append(fpid)
-                self.suppPIDs.sort()
+                    self.suppPIDs.add(fpid)
 
             if ecu not in self.obd2status:
                 #print "New ECU"
@@ -1065,14 +2094,19 @@ class OBD2:
                 self.obd2status[ecu]['inspmons'] = []
                 self.obd2status[ecu]['cyclemons'] = []
 
-            if pid in info_PIDs:
-                if 0 in rec['values'][ecu] and len(rec['values'][ecu][0]) == 3:
+            if pid in info_PIDset:
+                if len(rec['values'][ecu]) > 0 and len(rec['values'][ecu][0]) == 3:
                     self.info[ecu][ pidmap[pid] ] = rec['values'][ecu][0][1]
+                    # now that we know who made the vehicle, use their PID & DTC definitions
+                    if pid == '0902':
+                        self.def_VIN = self.info[ecu]['VIN']
+                        self.use_definitions()
+                        self.reader.save_protocol( self.info[ecu]['VIN'] )
 
-            elif pid in status_PIDs:
+            elif pid in status_PIDset:
                 # 01 01 - lots of info...
                 if pid == "0101" :
-                    self.obd2status[ecu]['scantime'] = rec['timestamp']
+                    self.obd2status[ecu]['scantime'] = ts
                     vals = rec['values'][ecu]
                     for v in vals:
                         if v[0] == 'MIL':
@@ -1085,7 +2119,7 @@ class OBD2:
                             self.obd2status[ecu]['inspmons'].append(v)
                 # 01 41 - lots of info...
                 elif pid == "0141" :
-                    self.obd2status[ecu]['scantime'] = rec['timestamp']
+                    self.obd2status[ecu]['scantime'] = ts
                     vals = rec['values'][ecu]
                     for v in vals:
                         if v[0] == 'Continuous Monitor':
@@ -1094,31 +2128,18 @@ class OBD2:
                             self.obd2status[ecu]['cyclemons'].append(v)
                 # normalish
                 else :
-                    if len(rec['values'][ecu][0]) == 3:
+                    if len(rec['values'][ecu]) > 0 and len(rec['values'][ecu][0]) == 3:
                         self.obd2status[ecu][ pidmap[pid] ] = rec['values'][ecu][0][1]
        
             elif pid == '03':
-                # TODO - add list of DTCs to self.obd2status[ecu]['DTCs']
-                pass
+                self.obd2status[ecu]['DTCs'] = [ v[1] for v in rec['values'][ecu] ]
        
             elif pid == '04':
                 # no data, just skip
                 pass
        
             # save all data for later display by tui/gui
-            # self.sensor_readings --> ECU --> PID--> scantime--> list of values
-            if not ecu in self.sensor_readings:
-                self.sensor_readings[ecu] = {}
-            if not pid in self.sensor_readings[ecu]:
-                self.sensor_readings[ecu][pid] = {}
-            if not ts in self.sensor_readings[ecu][pid]:
-                self.sensor_readings[ecu][pid][ts] = []
-                self.sensor_readings[ecu][pid][ts].extend( rec['values'][ecu] )
-            else:
-                while ts in self.sensor_readings[ecu][pid] :
-                    ts += "0"
-                self.sensor_readings[ecu][pid][ts] = []
-                self.sensor_readings[ecu][pid][ts].extend( rec['values'][ecu] )
+            self.sensor_readings.add( ecu, pid, ts, rec['values'][ecu] )
                 
 
 
@@ -1129,8 +2150,8 @@ class OBD2:
 
         # populate list of pids to check
         sensor_pids = []
-        for spid in self.suppPIDs:
-            if spid[1] == '1' and spid not in feature_PIDs and spid not in info_PIDs and spid not in status_PIDs :
+        for spid in self.suppPIDs.mode_pids(0x01):
+            if spid not in nonsensor_PIDset :
                 sensor_pids.append(spid)
 
         return sensor_pids
@@ -1141,18 +2162,297 @@ class OBD2:
         # one pass through the supported PIDs in mode 0x01
         # check the readings of each sensor
 
-        dec_rec = decode_obd2_record( self.reader.OBD2_cmd(pid) )
-        self.store_info( dec_rec )
+        # don't wait on a PID that has been timing out until its backoff is over
+        if self.pid_blocked(pid):
+            return
+
+        self.store_reply( pid, self.reader.OBD2_cmd(pid) )
 
         #self.show_last_reading( pid )
 
 
 
+    def use_definitions(self):
+        """ Switch to the PID & DTC definitions for this vehicle. """
+        defs_lock.acquire()
+        try:
+            select_definitions( self.def_VIN )
+        finally:
+            defs_lock.release()
+
+
+    def decode(self, rec):
+        """ Decode a reply with the PID & DTC definitions for this vehicle. """
+        # the definitions are module wide (see select_definitions), vehicles in other threads take turns
+        defs_lock.acquire()
+        try:
+            select_definitions( self.def_VIN )
+            return decode_obd2_record( rec )
+        finally:
+            defs_lock.release()
+
+
+    def store_reply(self, pid, rec):
+        """ Decode and store the reply to a PID request, returns the decoded records. """
+        if rec.get('error') in nodata_errors:
+            self.pid_failed(pid, rec['error'])
+        elif pid in self.pid_failures:
+            del self.pid_failures[pid]
+
+        # several mode 01 PIDs in one request, see plan_polls()
+        if len( batch_PIDs(pid) ) > 1:
+            dec_recs = [ self.decode(r) for r in split_multi_pid_record(rec) ]
+        else:
+            dec_recs = [ self.decode( rec ) ]
+
+        for dec_rec in dec_recs:
+            self.store_info( dec_rec )
+        return dec_recs
+
+
+
+    #
+    #  Non-blocking scans, driven by an obd2_reader.OBD2loop
+    #
+
+    def scan_pid_async(self, pid, loop):
+        """ Queue a PID request on loop, the reply is decoded & stored when it comes in. """
+        # returns the OBD2request, its 'decoded' attribute gets the decoded records
+        #   or None when the PID is quarantined
+        if self.pid_blocked(pid):
+            return None
+
+        def store(req):
+            req.decoded = []
+            if req.error is None:
+                req.decoded = self.store_reply( pid, req.record )
+
+        req = loop.OBD2_cmd(self.reader, pid)
+        req.add_callback(store)
+        return req
+
+
+    def stream(self, pids, loop):
+        """ Generator of decoded records for pids, round and round, running loop as it goes. """
+        # other readers on the same loop keep going while we wait on this one
+        while 1:
+            reqs = [ self.scan_pid_async(pid, loop) for pid in pids ]
+            reqs = [ req for req in reqs if req is not None ]
+            for req in reqs:
+                loop.run_until(req)
+                if req.error is not None:
+                    raise req.error
+                for dec_rec in req.decoded:
+                    yield dec_rec
+            if reqs == []:
+                # everything is quarantined, don't spin
+                loop.run_once(backoff_first)
+
+
+
+    #
+    #  Sensor polling at different rates per PID
+    #
+
+    def set_poll_rate(self, pid, rate, priority=0):
+        """ Poll a PID at the given rate (Hz), rate 0 stops polling it. """
+        # priority breaks ties between PIDs that are due at the same time, higher goes first
+        if rate <= 0:
+            if pid in self.poll_sched:
+                del self.poll_sched[pid]
+        else:
+            if pid not in self.poll_sched:
+                self.poll_sched[pid] = { 'next' : monotonic(), 'count' : 0, 'start' : None, 'last' : None }
+            self.poll_sched[pid]['rate']     = float(rate)
+            self.poll_sched[pid]['priority'] = priority
+
+        self.poll_queue = [ [e['next'], -e['priority'], p] for (p, e) in self.poll_sched.iteritems() ]
+        heapq.heapify(self.poll_queue)
+
+
+    def poll_next(self):
+        """ Scan the PID with the earliest deadline, waiting for it to come due. """
+        if len(self.poll_queue) == 0:
+            return None
+
+        [deadline, prio, pid] = heapq.heappop(self.poll_queue)
+        e = self.poll_sched[pid]
+
+        now = monotonic()
+        if deadline > now:
+            time.sleep(deadline - now)
+
+        # backed off or quarantined, come back right when it is time to try again
+        if self.pid_blocked(pid):
+            e['next'] = self.pid_failures[pid]['retry']
+            heapq.heappush(self.poll_queue, [e['next'], prio, pid])
+            return pid
+
+        if e['start'] is None:
+            e['start'] = monotonic()
+
+        self.scan_pid(pid)
+        e['count'] += 1
+        e['last'] = monotonic()
+
+        # running late, don't try to catch up with a burst of requests
+        e['next'] = max( deadline + 1.0 / e['rate'], monotonic() )
+        heapq.heappush(self.poll_queue, [e['next'], prio, pid])
+        return pid
+
+
+    def poll(self, duration):
+        """ Poll the scheduled PIDs for the given number of seconds. """
+        end = monotonic() + duration
+        while len(self.poll_queue) > 0:
+            # don't wait past the end for the next PID to come due
+            if self.poll_queue[0][0] >= end:
+                time.sleep( max(0, end - monotonic()) )
+                break
+            self.poll_next()
+
+
+    def poll_rates(self):
+        """ Compare the achieved polling rates to the requested rates. """
+        # rates[pid] = [requested Hz, achieved Hz]
+        rates = {}
+        for (pid, e) in self.poll_sched.iteritems():
+            achieved = 0.0
+            # count the intervals between polls
+            if e['count'] > 1:
+                achieved = (e['count'] - 1) / (e['last'] - e['start'])
+            rates[pid] = [ e['rate'], achieved ]
+        return rates
+
+
+
+    #
+    #  PIDs that stop answering
+    #
+
+    def pid_failed(self, pid, error):
+        """ Back off from a PID that didn't get an answer, quarantine it if it keeps failing. """
+        if pid not in self.pid_failures:
+            self.pid_failures[pid] = { 'fails' : 0, 'quarantined' : False }
+        f = self.pid_failures[pid]
+        f['fails'] += 1
+        f['error']  = error
+        if f['fails'] >= quarantine_after:
+            f['quarantined'] = True
+            f['retry'] = monotonic() + quarantine_probe
+        else:
+            f['retry'] = monotonic() + min( backoff_first * 2 ** (f['fails'] - 1), backoff_max )
+
+
+    def pid_blocked(self, pid):
+        """ Check whether a PID is backed off or quarantined right now. """
+        return pid in self.pid_failures and monotonic() < self.pid_failures[pid]['retry']
+
+
+    def quarantined(self):
+        """ List the PIDs the vehicle has stopped answering. """
+        # [pid, failures in a row, last error, seconds until the next probe]
+        now = monotonic()
+        return [ [pid, f['fails'], f['error'], max(0, f['retry'] - now)]
+                 for (pid, f) in sorted(self.pid_failures.iteritems()) if f['quarantined'] ]
+
+
+    def pid_latency(self, cmd):
+        """ Estimate the round trip time of a command from the reader's history. """
+        # 90th percentile of the recent round trips, falling back on the
+        #   average of everything measured so far, or a guess
+        samples = self.reader.latency.get(cmd)
+        if samples:
+            samples = sorted(samples)
+            return samples[ int(0.9 * (len(samples) - 1)) ]
+
+        allsamples = []
+        for v in self.reader.latency.itervalues():
+            allsamples.extend(v)
+        if len(allsamples) > 0:
+            return sum(allsamples) / len(allsamples)
+        return default_latency
+
+
+    def plan_polls(self, rates, headroom=0.8):
+        """ Plan a polling schedule for the requested rates, and predict which PIDs will fall short. """
+        # rates[pid] = requested Hz
+        # headroom is the fraction of the link we are willing to fill
+        #
+        # returns plan = {
+        #   'schedule'    : list of [cmd, Hz, latency], cmd may be several mode 01 PIDs batched together
+        #   'utilization' : predicted fraction of the link in use
+        #   'predicted'   : predicted[pid] = achievable Hz
+        #   'misses'      : PIDs that will not reach their requested rate
+        # }
+        schedule = []
+
+        # on CAN, mode 01 sensors polled at the same rate can share a request
+        batchable = {}
+        for pid in sorted(rates.keys()):
+            if self.reader.Style == 'can' and len(pid) == 4 and pid[0:2] == '01' and pid not in nonsensor_PIDset:
+                batchable.setdefault(rates[pid], []).append(pid)
+            else:
+                schedule.append( [pid, rates[pid]] )
+
+        for (rate, pids) in batchable.iteritems():
+            for i in range(0, len(pids), max_batch_PIDs):
+                batch = pids[i:i+max_batch_PIDs]
+                schedule.append( [ '01' + ''.join([ p[2:4] for p in batch ]), rate ] )
+
+        # until it has been measured, a batched request takes about as long as its slowest member
+        utilization = 0.0
+        for entry in schedule:
+            cmd = entry[0]
+            if cmd in self.reader.latency:
+                latency = self.pid_latency(cmd)
+            else:
+                latency = max([ self.pid_latency(pid) for pid in batch_PIDs(cmd) ])
+            entry.append(latency)
+            utilization += entry[1] * latency
+
+        # the scheduler shares an overloaded link out evenly, every PID slows down by the same factor
+        scale = 1.0
+        if utilization > headroom:
+            scale = headroom / utilization
+
+        predicted = {}
+        misses = []
+        for [cmd, rate, latency] in schedule:
+            for pid in batch_PIDs(cmd):
+                predicted[pid] = rate * scale
+                if scale < 1.0:
+                    misses.append(pid)
+
+        return {
+            'schedule'    : sorted(schedule),
+            'utilization' : utilization,
+            'predicted'   : predicted,
+            'misses'      : sorted(misses)
+        }
+
+
+    def apply_plan(self, plan):
+        """ Put the requests of a plan from plan_polls() on the polling schedule. """
+        for [cmd, rate, latency] in plan['schedule']:
+            self.set_poll_rate(cmd, rate)
+
+
+
     def scan_pid_list(self, pidlist):
         """ Scan vehicle for sensor readings using the given pids. """
         # one pass through the supported PIDs in mode 0x01
         # check the readings of each sensor
 
+        # with a reader thread, queue all the requests up front,
+        #   the link stays busy with the next one while we decode & store
+        if self.reader.io_thread is not None:
+            requests = [ [pid, self.reader.OBD2_cmd_async(pid)] for pid in pidlist if not self.pid_blocked(pid) ]
+            for [pid, req] in requests:
+                self.store_reply( pid, req.result() )
+                self.show_last_reading( pid )
+            return
+
         for pid in pidlist:
 
             self.scan_pid( pid )
@@ -1168,6 +2468,76 @@ class OBD2:
 
 
 
+    #
+    #  Queries on the stored readings, for UI code, see SensorStore
+    #
+
+    def reading_ecu(self, pid, ecu=None):
+        """ The ECU to answer a query from: the one given, or the one that reported pid last. """
+        if ecu is not None:
+            return ecu
+        latest = None
+        for e in self.sensor_readings.ecus(pid):
+            t = self.sensor_readings.latest_values(e, pid)[0]
+            if latest is None or t > latest:
+                [ecu, latest] = [e, t]
+        return ecu
+
+
+    def latest(self, pid, ecu=None):
+        """ [time, values] of the newest reading of pid, values as [desc, value, unit], None if there is none. """
+        ecu = self.reading_ecu(pid, ecu)
+        if ecu is None:
+            return None
+        return self.sensor_readings.latest_values(ecu, pid)
+
+
+    def rollup(self, pid, width, t0=0, t1=None, ecu=None):
+        """ Summaries of pid over back to back windows of width seconds (see rollup_windows),
+             { sensor : { start, count, mean, min, max } } of those starting at t0 <= start < t1. """
+        ecu = self.reading_ecu(pid, ecu)
+        rollups = self.sensor_readings.rollups.get(ecu, {}).get(pid, {})
+        if t1 is None:
+            t1 = float('inf')
+        result = {}
+        for sensor in rollups:
+            if width in rollups[sensor]:
+                result[sensor] = rollups[sensor][width].windows(t0, t1)
+        return result
+
+
+    def window(self, pid, t0, t1=None, ecu=None, step=None):
+        """ Readings of pid with t0 <= time < t1, { sensor : [times, values] } oldest first.
+             With step, the reading held every step seconds instead (see deadbands). """
+        # times & values are numpy arrays when numpy is there
+        ecu = self.reading_ecu(pid, ecu)
+        rings = self.sensor_readings.rings.get(ecu, {}).get(pid, {})
+        if step is not None:
+            if t1 is None:
+                t1 = max( [ rings[sensor].latest()[0] for sensor in rings ] + [t0] ) + step
+            return dict( [ (sensor, rings[sensor].resample(t0, t1, step)) for sensor in rings ] )
+        if t1 is None:
+            t1 = float('inf')
+        return dict( [ (sensor, rings[sensor].slice(t0, t1)) for sensor in rings ] )
+
+
+    def stats(self, pid, window=None, ecu=None):
+        """ { sensor : { count, mean, std, min, max, unit } } of pid over the last window seconds, or all along. """
+        # sensors that read as text are left out
+        ecu = self.reading_ecu(pid, ecu)
+        rings = self.sensor_readings.rings.get(ecu, {}).get(pid, {})
+        result = {}
+        for sensor in rings:
+            if window is None:
+                st = rings[sensor].stats()
+            else:
+                t1 = rings[sensor].latest()[0]
+                st = rings[sensor].stats(t1 - window, float('inf'))
+            if st is not None:
+                result[sensor] = st
+        return result
+
+
     def show_last_reading(self, pid):
         """ Display the most recent reading for a given sensor. """
         
@@ -1175,13 +2545,13 @@ class OBD2:
         c1 = 40
         c2 = 8
 
-        for ecu in self.sensor_readings :
-            mts = max( self.sensor_readings[ecu][pid] ) 
-            print ecu, "-", pid, "-", mts, ":",
+        for ecu in self.sensor_readings.ecus(pid) :
+            [mts, readings] = self.latest(pid, ecu)
+            print ecu, "-", pid, "-", "%.3f" % mts, ":",
             vals = 0
-            if len(self.sensor_readings[ecu][pid][mts]) == 0:
+            if len(readings) == 0:
                 print ""
-            for val in self.sensor_readings[ecu][pid][mts] :
+            for val in readings :
                 if vals > 0:
                     print "                        ",
                 vals += 1
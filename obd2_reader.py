@@ -38,11 +38,43 @@ import serial  #
 import string  # split 
 import time    # pause 
 import sys     # write to stderr
+import collections  # latency history
+import re           # AT command settings, see at_family
+import threading    # background I/O thread
+import select       # wait on several readers at once, see OBD2loop
+import shelve       # protocol cache
+import ctypes       # monotonic clock
+import ctypes.util
+import Queue        # requests for the I/O thread
 
 import pprint  # debug
 
 
 
+# time.time() can jump (NTP, the user setting the clock...),
+#   time replies & deadlines with CLOCK_MONOTONIC where we can get at it
+class timespec(ctypes.Structure):
+    _fields_ = [ ('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long) ]
+
+try:
+    librt = ctypes.CDLL( ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True )
+    clock_gettime = librt.clock_gettime
+    clock_gettime.argtypes = [ ctypes.c_int, ctypes.POINTER(timespec) ]
+    CLOCK_MONOTONIC = 1
+except (OSError, AttributeError, TypeError):
+    clock_gettime = None
+
+def monotonic():
+    """ Seconds on a clock that never goes backwards, only differences mean anything."""
+    if clock_gettime is None:
+        return time.time()
+    ts = timespec()
+    if clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(ts)) != 0:
+        return time.time()
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+
+
 class OBD2reader:
     """ OBD2reader abstracts the communication with the OBD-II vehicle."""
     def __init__(self, devtype, device):
@@ -61,10 +93,51 @@ class OBD2reader:
         #
         self.attr         = {}       # the list of device attributes and their values
         self.attr_cmds    = {}       # the list of supported attribute at commands, and the associated attribute
+        self.attr_time    = {}       # when each attribute was last read from the device
+        self.attr_ttl     = {}       # seconds an attribute stays good, the others never change while connected
+        self.attr_eager   = []       # attributes to read while connecting, the others are read when first looked at
+        self.at_state     = {}       # settings made since the last reset, by family, ie. 'ATH' : 'ATH1', see interpret_at_cmd
+        self.at_replay    = []       # families of settings to put back after a warm start, in order
+        self.at_patterns  = {}       # the commands of each family, ie. 'ATH' : 'ATH[01]$'
+        self.recovered    = 0        # how far the last recover() had to go, 1 = resync, 2 = warm start, 3 = full reset
         #
         self.RecordTrace  = 0        # 0 = no, 1 = yes record a trace of the serial session
         self.tf_out       = None     # file to record trace to
         #
+        self.latency      = {}       # recent round trip times (seconds) of each command, see record_latency
+        self.latency_hist = 100      # how many round trips to remember per command
+        self.class_latency = {}      # the same, per class of command, see cmd_class
+        #
+        self.rtrv_floor   = 0.3      # shortest time to wait for a reply (seconds)
+        self.rtrv_ceiling = 3        # longest time to wait for a reply (seconds), also used until we have measurements
+        self.rtrv_margin  = 2.0      # wait this many times the 99th percentile of earlier replies
+        self.rtrv_samples = 5        # replies needed before trusting the percentile
+        self.timeouts     = {}       # number of replies we gave up waiting for, per class
+        self.empty_replies = {}      # number of prompts that came back with nothing, per class
+        self.timeout_streak = {}     # timeouts in a row per class, each one doubles the wait
+        self.sent_cmd     = ''       # last command sent, and when
+        self.sent_time    = 0        #   wall-clock
+        self.sent_mono    = 0        #   monotonic, see monotonic()
+        self.recv_time    = None     # when the prompt ending the last reply came in
+        self.recv_mono    = None
+        self.last_timeout = 0        # 1 if we gave up waiting for the last reply
+        #
+        self.io_thread    = None     # background thread that owns the port, see start_thread
+        self.io_queue     = None     # OBD2request objects waiting for the I/O thread
+        #
+        self.poll_wait    = 0.01     # seconds between looks at a port we can't select() on
+        #
+        self.ProtoCache   = None     # shelve file of protocols found earlier, None = always search, see cached_protocol
+        self.VIN          = None     # vehicle we expect to find, its protocol beats the one last used on this adapter
+        self.rx_record    = []       # raw_record from the last RTRV_steps
+        self.obd2_record  = None     # obd2_record from the last OBD2_cmd_steps
+        #
+        self.last_error   = None     # why triage_record dropped the last record, ie. 'NO DATA', None if it didn't
+        #
+        self.pending_max  = 5        # seconds to keep waiting on an ECU that replied "response pending" (7F xx 78)
+        self.busy_retries = 3        # times to repeat a command an ECU replied "busy" (7F xx 21) to
+        self.busy_backoff = 0.1      # seconds before the first repeat, doubles each time
+        #
         if self.Type == "SERIAL":
             self.Port     = None     # connect later
         elif self.Type == "FILE":
@@ -82,6 +155,22 @@ class OBD2reader:
             'ATDPN' :  "ProtoNum",
             'ATRV'  :  "Voltage",
             }
+            # needed to parse replies
+            self.attr_eager = ['ProtoNum']
+            self.attr_ttl   = { 'Voltage' : 10 }
+            # echo, linefeeds, spaces, headers, adaptive timing, timeout, protocol, CAN header
+            self.at_replay = ['ATE', 'ATL', 'ATS', 'ATH', 'ATAT', 'ATST', 'ATSP', 'ATSH']
+            # whole commands only, ATSH7E0 isn't spaces & ATLP (low power) isn't linefeeds
+            self.at_patterns = {
+            'ATE'  : re.compile( r'ATE[01]$' ),
+            'ATL'  : re.compile( r'ATL[01]$' ),
+            'ATS'  : re.compile( r'ATS[01]$' ),
+            'ATH'  : re.compile( r'ATH[01]$' ),
+            'ATAT' : re.compile( r'ATAT[0-2]$' ),
+            'ATST' : re.compile( r'ATST[0-9A-F]{2}$' ),
+            'ATSP' : re.compile( r'ATSPA?[0-9A-C]$' ),
+            'ATSH' : re.compile( r'ATSH([0-9A-F]{3}|[0-9A-F]{6}|[0-9A-F]{8})$' ),
+            }
         else:
             pass
         self.clear_attr()
@@ -100,7 +189,9 @@ class OBD2reader:
 
 
     # "obd2_record" - a dict that includes:
-    #            - a timestamp
+    #            - a timestamp, wall-clock float of when the reply came in
+    #            - sent, the same for when the command went out
+    #            - mono_sent & mono_recv, the same on a monotonic clock, for latency & jitter
     #            - the command sent
     #            - an dict of responses from each ECU
     #               - key: ECU ID
@@ -120,6 +211,10 @@ class OBD2reader:
 
     def connect(self):
         """ Opens serial connection to reader device"""
+        self.run_steps( self.connect_steps() )
+
+    def connect_steps(self):
+        """ connect() as a series of steps, see run_steps"""
         if (self.Type == "SERIAL"):
             if (self.Port== None):
                 raise self.ErrorNoPortDefined("Can't connect, no serial port defined.")
@@ -129,23 +224,24 @@ class OBD2reader:
                 #try:
                     self.Port.open()
                     self.State = 1
-                    time.sleep(0.5)
+                    yield [0.5, 0]
                     #self.SERIAL_SEND_cmd( ' ' )
                     #self.flush_recv_buf()
-                    self.SERIAL_FLUSH_buffers()
-                    time.sleep(0.5)
+                    for w in self.SERIAL_FLUSH_steps(): yield w
+                    yield [0.5, 0]
                     self.SERIAL_SEND_cmd( ' ' )
-                    time.sleep(0.5)
-                    self.SERIAL_FLUSH_buffers()
+                    yield [0.5, 0]
+                    for w in self.SERIAL_FLUSH_steps(): yield w
                     if self.debug > 1:
                         print "Trying to send reset command..."
-                    self.reset()
-                    time.sleep(0.5)
+                    for w in self.reset_steps(): yield w
+                    yield [0.5, 0]
                     # reset protocol to auto
-                    self.reset_protocol()
-                    time.sleep(0.5)
-                    # report what protocol was discovered
-                    self.rtrv_attr()
+                    for w in self.reset_protocol_steps(): yield w
+                    yield [0.5, 0]
+                    # report what protocol was discovered, the other attributes can wait until they are needed
+                    for w in self.rtrv_attr_steps(self.attr_eager): yield w
+                    self.save_protocol()
                 #except serial.SerialException as inst:
                 # self.State = 0
                 # raise inst
@@ -173,6 +269,7 @@ class OBD2reader:
 
     def disconnect(self):
         """ Resets reader device and closes serial connection. """
+        self.stop_thread()
         if (self.Port!= None):
             if self.State==1:
                 self.reset()
@@ -208,27 +305,174 @@ class OBD2reader:
         """Send an OBD2 PID to the vehicle, get the result, and format it into a standard record"""
         obd2_record = []
 
+        # the I/O thread owns the port, hand the command over and wait for it
+        if self.io_thread is not None and threading.current_thread() is not self.io_thread:
+            return self.OBD2_cmd_async(cmd).result()
+
+        self.run_steps( self.OBD2_cmd_steps(cmd) )
+        return self.obd2_record
+
+
+    def OBD2_cmd_steps(self, cmd):
+        """OBD2_cmd() as a series of steps, see run_steps, the result is left in obd2_record"""
+        self.obd2_record = None
+        self.recv_mono = None
         self.SEND_cmd(cmd)
-        record = self.RTRV_record()
+        for w in self.RTRV_steps(): yield w
+        record = self.rx_record
+
+        # an ECU that is too busy (7F xx 21) isn't a failure yet, nor is one that was still working on it
+        #   (7F xx 78) when the reader gave up, SERIAL_RTRV_steps already waits pending_max for those
+        busy_wait = self.busy_backoff
+        busy_tries = 0
+        while self.Type == "SERIAL":
+            nrcs = [ n[2] for n in self.negative_responses(record) ]
+            answered = len(record) - 1 > len(nrcs)
+            if ('21' in nrcs or '78' in nrcs) and not answered and busy_tries < self.busy_retries:
+                # ask again after a pause, a little longer each time
+                yield [busy_wait, 0]
+                busy_wait *= 2
+                busy_tries += 1
+                self.SEND_cmd(cmd)
+                for w in self.RTRV_steps(): yield w
+                record = self.rx_record
+            else:
+                break
 
         # check that the ELM headers match the original cmd
-        if record[0][0] != cmd:
+        if len(record) > 0 and len(record[0]) > 0 and str.upper(record[0][0]) != str.upper(cmd):
             print "PANIC! - cmd is different"
             print "cmd:", cmd, "record[0][0]:", record[0][0]
-
-        # Format result into a standard OBD2 record
-        obd2_record = self.triage_record( record )
+            # the reply to some other command, don't decode it, and don't let ours get in the way of the next one
+            if self.Type == "SERIAL":
+                for w in self.SERIAL_RESYNC_steps(): yield w
+            obd2_record = []
+            self.last_error = 'OUT OF STEP'
+        else:
+            # Format result into a standard OBD2 record
+            obd2_record = self.triage_record( record )
 
         if obd2_record == []:
            obd2_record = { 'command'   : cmd ,
                            'responses' : { '7E8' : [] }, 
                            'timestamp' : 0  }
+           # let the caller know why there is nothing
+           if self.last_error is not None:
+               obd2_record['error'] = self.last_error
 
-        # set timestamp 
+        # set timestamps, wall-clock & monotonic when the command went out and the reply came in
         #scantime = time.time()
-        obd2_record['timestamp'] = str(int(time.time()))
+        if self.Type != "SERIAL" or self.recv_mono is None:
+            # no reply, or no way to tell
+            self.recv_time = time.time()
+            self.recv_mono = monotonic()
+        if self.Type != "SERIAL":
+            self.sent_time = self.recv_time
+            self.sent_mono = self.recv_mono
+        obd2_record['timestamp'] = self.recv_time
+        obd2_record['mono_recv'] = self.recv_mono
+        obd2_record['sent']      = self.sent_time
+        obd2_record['mono_sent'] = self.sent_mono
+
+        self.obd2_record = obd2_record
+
+
+    def run_steps(self, steps):
+        """Run a series of steps to the end, sleeping in between"""
+        # steps are generators that yield [wait, readable] whenever they have to wait:
+        #   wait     - seconds until they want to go on
+        #   readable - 1 if they should go on sooner once the port has something to read
+        # here we just sleep, OBD2loop can juggle the steps of many readers at once
+        for [wait, readable] in steps:
+            if readable:
+                wait = min(wait, self.poll_wait)
+            if wait > 0:
+                time.sleep(wait)
+
+
+    def fileno(self):
+        """File descriptor of the port, for select()"""
+        return self.Port.fileno()
+
+
+    def OBD2_cmd_async(self, cmd):
+        """Queue an OBD2 PID for the I/O thread, returns an OBD2request to collect the record from"""
+        req = OBD2request(cmd)
+        if self.io_thread is None:
+            # no thread, just do it now
+            req.run(self)
+        else:
+            self.io_queue.put(req)
+        return req
+
+
+    def start_thread(self):
+        """Hand the port over to a background I/O thread"""
+        # from now on OBD2_cmd & OBD2_cmd_async go through the thread,
+        #   so decoding can overlap the next serial transaction
+        if self.io_thread is not None:
+            return
+        self.io_queue  = Queue.Queue()
+        self.io_thread = threading.Thread(target=self.io_loop, name="OBD2reader I/O")
+        self.io_thread.daemon = True
+        self.io_thread.start()
+
+
+    def stop_thread(self):
+        """Finish the queued commands and stop the I/O thread"""
+        if self.io_thread is None:
+            return
+        self.io_queue.put(None)
+        self.io_thread.join()
+        self.io_thread = None
+        self.io_queue  = None
+
+
+    def io_loop(self):
+        """Body of the I/O thread: run queued commands until told to stop"""
+        while 1:
+            req = self.io_queue.get()
+            if req is None:
+                break
+            req.run(self)
+
+
+    def record_latency(self, cmd, secs):
+        """Remember the round trip time of a command"""
+        cmd = str.upper(cmd)
+        if cmd not in self.latency:
+            self.latency[cmd] = collections.deque(maxlen=self.latency_hist)
+        self.latency[cmd].append(secs)
+        cc = self.cmd_class(cmd)
+        if cc not in self.class_latency:
+            self.class_latency[cc] = collections.deque(maxlen=self.latency_hist)
+        self.class_latency[cc].append(secs)
+
+
+    def cmd_class(self, cmd):
+        """Group commands that take about as long to answer"""
+        # AT commands vary a lot (ATZ vs. ATRV), OBD2 commands are grouped by mode
+        cmd = str.upper(cmd)
+        if cmd[0:2] == 'AT':
+            return cmd
+        return cmd[0:2]
 
-        return obd2_record
+
+    def rtrv_deadline(self, cmd):
+        """How long to wait for the reply to a command"""
+        # learned from earlier replies to the same command, or the same class of command
+        cc = self.cmd_class(cmd)
+        samples = self.latency.get( str.upper(cmd), [] )
+        if len(samples) < self.rtrv_samples:
+            samples = self.class_latency.get( cc, [] )
+        if len(samples) < self.rtrv_samples:
+            return self.rtrv_ceiling
+
+        samples = sorted(samples)
+        wait = samples[ int(0.99 * (len(samples) - 1)) ] * self.rtrv_margin
+        # a slow reply isn't necessarily a hung reader, back off after each timeout
+        wait *= 2 ** self.timeout_streak.get(cc, 0)
+        return min( max(wait, self.rtrv_floor), self.rtrv_ceiling )
 
 
     def SEND_cmd(self, cmd):
@@ -237,7 +481,7 @@ class OBD2reader:
         # check for pending command results to be retrieved
         if self.recwaiting != 0: 
             #print "ARGH! can't send cmd before result of last command is retrieved!!!"
-            raise ErrorRtrvBeforeSend("ARGH! can't send cmd before result of last command is retrieved!!!")
+            raise self.ErrorRtrvBeforeSend("ARGH! can't send cmd before result of last command is retrieved!!!")
 
         # send command
         if self.State != 1:
@@ -247,6 +491,9 @@ class OBD2reader:
             if self.Device == "ELM327":
                 #self.ELM327_SEND_cmd(cmd)
                 self.SERIAL_SEND_cmd(cmd)
+                self.sent_cmd  = cmd
+                self.sent_time = time.time()
+                self.sent_mono = monotonic()
                 # mark that there is now a record waiting to be retrieved
                 self.recwaiting = 1
             else:
@@ -263,32 +510,35 @@ class OBD2reader:
 
     def RTRV_record(self):
         """Get the record of the last command and response from the vehicle"""
+        self.run_steps( self.RTRV_steps() )
+        # this record to be returned may be empty if the last command was an AT command or there was line noise in the tracefile
+        # callers should be able to deal with and empty record
+        return self.rx_record
+
+    def RTRV_steps(self, max_wait=None):
+        """RTRV_record() as a series of steps, see run_steps, the record is left in rx_record"""
+        self.rx_record = []
 
         # check if there are pending command results to be retrieved
         if self.recwaiting == 0: 
-            return []
+            return
 
-        record = []
-        
         # retrieve the result
         if self.State != 1:
             print "Can't send OBD2 command, device not connected"
             raise self.ErrorNotConnected("Can't send OBD2 command")
         elif self.Type == "SERIAL":
             if self.Device == "ELM327":
-                record = self.SERIAL_RTRV_record()
+                for w in self.SERIAL_RTRV_steps(max_wait): yield w
                 self.recwaiting = 0
             else:
                 raise self.ErrorReaderNotRecognized("Unknown OBD2 Reader device")
         elif self.Type == "FILE":
             # trace has more records until EOF is hit
-            record = self.FILE_RTRV_record()
+            self.rx_record = self.FILE_RTRV_record()
         else:
             # unknown self.Type 
             pass
-        # this record to be returned may be empty if the last command was an AT command or there was line noise in the tracefile
-        # callers should be able to deal with and empty record
-        return record
 
 
 
@@ -303,9 +553,18 @@ class OBD2reader:
         #   - the result of an "AT" command 
         #   - the result of an OBD2 command 
    
+        self.last_error = None
+
+        # nothing came back, either we gave up waiting or the reader had nothing to say
+        if record == []:
+            if self.last_timeout == 1:
+                self.last_error = 'TIMEOUT'
+            else:
+                self.last_error = 'NO RESPONSE'
+            return []
+
         # skip over garbage 
-        if record == []           \
-          or record[0] == []     \
+        if record[0] == []     \
           or record[0][0] == ''  \
           or record[0][0] == '?' :
             #print "Garbage record.  Skipping."
@@ -320,6 +579,7 @@ class OBD2reader:
           if record[1][0] == '?' \
           or record[1][0] == 'NO':
             #print "Garbage record.  Skipping."
+            self.last_error = ' '.join(record[1])
             return []
 
         # record the changes made by AT commands
@@ -355,22 +615,17 @@ class OBD2reader:
         #  21  - busy repeat
         #  22  - conditions or sequence not correct 
         #  78  - response pending
-        if record[1][0] == '7F':
-            mode = record[1][1]
-            err  = record[1][2]
-            if err == 10:
-                print "General Error -- Mode:", mode
-            elif err == 11:
-                print "Service Not Supported Error -- Mode:", mode
-            elif err == 12:
-                print "Subfunction Not Supported or Invalid Format Error -- Mode:", mode
-            elif err == 21:
-                print "BUSY, Repeat -- Mode:", mode
-            elif err == 22:
-                print "Conditions or Sequence Not Correct -- Mode:", mode
-            elif err == 78:
-                print "Unknown Error -- Mode:", mode, " -- Error code:", err
-            return []
+        # drop the negative responses, any ECUs that did answer are still processed
+        negatives = self.negative_responses(record)
+        if len(negatives) > 0:
+            for [line, mode, err] in negatives:
+                # response pending is normal for slow requests, OBD2_cmd waits for the real answer
+                if err != '78':
+                    print self.nrc_messages.get(err, "Unknown Error"), "-- Mode:", mode, " -- Error code:", err
+            record = [ record[0] ] + [ record[l] for l in range(1, len(record)) if l not in [ n[0] for n in negatives ] ]
+            if len(record) < 2:
+                self.last_error = 'NRC ' + negatives[-1][2]
+                return []
 
 
         # format an OBD 2 command for further processing at a higher layer
@@ -383,6 +638,37 @@ class OBD2reader:
         return obd2_record
     
 
+    # negative response codes
+    nrc_messages = {
+        '10' : "General Error",
+        '11' : "Service Not Supported Error",
+        '12' : "Subfunction Not Supported or Invalid Format Error",
+        '21' : "BUSY, Repeat",
+        '22' : "Conditions or Sequence Not Correct",
+        '78' : "Response Pending"
+    }
+
+    def negative_responses(self, record):
+        """Find the negative responses (7F) in a record"""
+        # returns a list of [line number, mode, NRC]
+        # where the response starts on a line depends on the headers:
+        #   7F 01 12                  - no headers
+        #   7E8 03 7F 01 12           - CAN, ECU ID and PCI byte
+        #   48 6B 10 7F 01 12 XX      - old style, priority, receiver, sender ... checksum
+        i = 0
+        if self.Headers == 1:
+            if self.Style == 'can':
+                i = 2
+            else:
+                i = 3
+        negatives = []
+        for l in range(1, len(record)):
+            line = record[l]
+            if len(line) > i+2 and line[i] == '7F':
+                negatives.append( [ l, line[i+1], line[i+2] ] )
+        return negatives
+
+
     def interpret_at_cmd(self, record):
         """Record the results of an AT command"""
 
@@ -435,10 +721,25 @@ class OBD2reader:
             if self.debug > 0 :
                 print "AT: Headers ON"
 
+        # keep track of the settings, to put them back after a warm start
+        if cmd in ['ATZ', 'ATWS', 'ATD']:
+            self.at_state = {}
+        else:
+            family = self.at_family(cmd)
+            if family is not None and len(record) > 1 and 'OK' in record[-1]:
+                self.at_state[family] = cmd
     
         return
 
 
+    def at_family(self, cmd):
+        """Which of the settings in at_replay an AT command changes, None if none of them"""
+        for f in self.at_replay:
+            if self.at_patterns[f].match(cmd):
+                return f
+        return None
+
+
     # fixme - some sections incomplete
     def format_obd2_record(self, record):
         """Format the results of an OBD2 command into a standard format for processing"""
@@ -450,8 +751,8 @@ class OBD2reader:
     
         # the timestamp of when the command was sent
         #ts = '1333808134' # a ctime measurement
-        # no timestamps from raw tracefiles
-        ts = '0'
+        # no timestamps from raw tracefiles, OBD2_cmd fills them in
+        ts = 0
         # the command sent
         cmd = str.upper(record[0][0])
         # the results from each responding ECU
@@ -672,14 +973,19 @@ class OBD2reader:
     def clear_attr(self):
         """ Clears data attributes"""
         # data attributes that should get filled in when reader is working
-        self.attr = {}
+        self.attr = ReaderAttrs(self)
+        self.attr_time = {}
         #for i in self.suppt_attr.keys():
         for k in self.attr_cmds.keys():
             self.attr[ self.attr_cmds[k] ] = "Unknown"
 
     # fixme - consider SERIAL vs. FILE
-    def rtrv_attr(self):
-        """ Retrieves data attributes"""
+    def rtrv_attr(self, names=None):
+        """ Retrieves data attributes, all of them or just the ones named"""
+        self.run_steps( self.rtrv_attr_steps(names) )
+
+    def rtrv_attr_steps(self, names=None):
+        """ rtrv_attr() as a series of steps"""
         #
         if self.debug > 1:
             print "Retrieving reader attributes..."
@@ -689,13 +995,32 @@ class OBD2reader:
             raise self.ErrorNotConnected("Can't retrieve reader attributes")
         else:
             if self.Device == "ELM327":
-                self.ELM327_rtrv_attr()
+                for w in self.ELM327_rtrv_attr_steps(names): yield w
             else:
                 raise self.ErrorReaderNotRecognized("Unknown OBD2 Reader device")
 
+    def refresh_attr(self, name):
+        """ Read an attribute from the device, if we haven't yet or it is too old"""
+        # called by ReaderAttrs when an attribute is looked at
+        cmds = [ k for k in self.attr_cmds.keys() if self.attr_cmds[k] == name ]
+        if cmds == [] or self.State != 1 or self.Type != "SERIAL" or self.recwaiting != 0:
+            return
+        fetched = self.attr_time.get(name)
+        ttl = self.attr_ttl.get(name)
+        if fetched is not None and (ttl is None or time.time() < fetched + ttl):
+            return
+        # even if the reader doesn't know, don't ask again until it expires
+        self.attr_time[name] = time.time()
+        # goes through the I/O thread if there is one, triage_record picks up the value
+        self.OBD2_cmd( cmds[0] )
+
     # fixme - consider SERIAL vs. FILE
     def reset(self):
         """ Resets device"""
+        self.run_steps( self.reset_steps() )
+
+    def reset_steps(self):
+        """ reset() as a series of steps"""
         #
         if self.debug > 1:
             print "Sending reset command..."
@@ -705,12 +1030,16 @@ class OBD2reader:
             raise self.ErrorNotConnected("Can't reset reader")
         else:
             if self.Device == "ELM327":
-                self.ELM327_reset()
+                for w in self.ELM327_reset_steps(): yield w
             else:
                 raise self.ErrorReaderNotRecognized("Unknown OBD2 Reader device")
 
     def reset_protocol(self):
         """ Resets device communication protocol"""
+        self.run_steps( self.reset_protocol_steps() )
+
+    def reset_protocol_steps(self):
+        """ reset_protocol() as a series of steps"""
         #
         if self.debug > 1:
             print "Resetting communication protocol..."
@@ -720,7 +1049,81 @@ class OBD2reader:
             raise self.ErrorNotConnected("Can't reset reader")
         else:
             if self.Device == "ELM327":
-                self.ELM327_reset_protocol()
+                for w in self.ELM327_reset_protocol_steps(): yield w
+            else:
+                raise self.ErrorReaderNotRecognized("Unknown OBD2 Reader device")
+
+    def recover(self):
+        """ Get back in step with the reader after a glitch, as gently as possible"""
+        # returns how far it had to go, see recovered
+        self.run_steps( self.recover_steps() )
+        return self.recovered
+
+    def recover_steps(self):
+        """ recover() as a series of steps"""
+        #
+        if self.debug > 1:
+            print "Recovering reader..."
+        #
+        if self.State != 1:
+            print "Can't recover reader, reader not connected"
+            raise self.ErrorNotConnected("Can't recover reader")
+        else:
+            if self.Device == "ELM327":
+                for w in self.ELM327_recover_steps(): yield w
+            else:
+                raise self.ErrorReaderNotRecognized("Unknown OBD2 Reader device")
+
+    def cached_protocol(self):
+        """ The protocol number found last time, for the expected VIN or else this adapter, None if unknown"""
+        if self.ProtoCache is None:
+            return None
+        proto_lock.acquire()
+        try:
+            protos = shelve.open(self.ProtoCache)
+            try:
+                for key in [ 'VIN:' + str(self.VIN), 'adapter:' + self.adapter_key() ]:
+                    if key in protos:
+                        return protos[key]
+                return None
+            finally:
+                protos.close()
+        finally:
+            proto_lock.release()
+
+    def save_protocol(self, VIN=None):
+        """ Remember the protocol in use for this adapter, and the vehicle if the VIN is given"""
+        pnum = self.attr.get('ProtoNum', "Unknown")
+        if self.ProtoCache is None or pnum == "Unknown" or pnum == '?':
+            return
+        # "A6" is 6 found automatically
+        pnum = pnum[-1]
+        proto_lock.acquire()
+        try:
+            protos = shelve.open(self.ProtoCache)
+            try:
+                protos['adapter:' + self.adapter_key()] = pnum
+                if VIN is not None:
+                    protos['VIN:' + VIN] = pnum
+            finally:
+                protos.close()
+        finally:
+            proto_lock.release()
+
+    def adapter_key(self):
+        """ Tell adapters apart by the port they are on"""
+        return str( getattr(self.Port, 'port', self.Port) )
+
+    def lock_protocol(self):
+        """ Stay on the protocol found by the automatic search"""
+        # saves the search after a reset, or when the vehicle is slow to answer
+        #
+        if self.State != 1:
+            print "Can't lock protocol, reader not connected"
+            raise self.ErrorNotConnected("Can't lock protocol")
+        else:
+            if self.Device == "ELM327":
+                self.ELM327_lock_protocol()
             else:
                 raise self.ErrorReaderNotRecognized("Unknown OBD2 Reader device")
 
@@ -736,40 +1139,137 @@ class OBD2reader:
     #  ELM327 specific functions (private)
     #
 
-    def ELM327_rtrv_attr(self):
+    def ELM327_rtrv_attr_steps(self, names=None):
         """ Retrieves data attributes"""
+        # back to back, each reply ends with the prompt so there is nothing to wait for
         #for i in self.suppt_attr.keys():
         for k in self.attr_cmds.keys():
+            if names is not None and self.attr_cmds[k] not in names:
+                continue
             self.SEND_cmd( k )
-            time.sleep(0.1)
-            self.interpret_at_cmd( self.RTRV_record() )
+            for w in self.RTRV_steps(): yield w
+            if self.rx_record != []:
+                self.interpret_at_cmd( self.rx_record )
+            self.attr_time[ self.attr_cmds[k] ] = time.time()
 
 
-    def ELM327_reset(self):
+    def ELM327_reset_steps(self):
         """ Resets device"""
         # FYI - interpret_at_cmd can't handle an empty list
 
         self.SEND_cmd("atz")    # reset ELM327 firmware
-        self.interpret_at_cmd( self.RTRV_record() )
+        for w in self.RTRV_steps(): yield w
+        self.interpret_at_cmd( self.rx_record )
 
         if self.Headers == 1:
             self.SEND_cmd("ath1")  # headers on
-            self.interpret_at_cmd( self.RTRV_record() )
+            for w in self.RTRV_steps(): yield w
+            self.interpret_at_cmd( self.rx_record )
 
 
-    def ELM327_reset_protocol(self):
+    def ELM327_reset_protocol_steps(self):
         """ Resets device"""
         # FYI - interpret_at_cmd can't handle an empty list
 
+        # try the protocol that worked last time first, the search can take several seconds
+        pnum = self.cached_protocol()
+        if pnum is not None:
+            self.SEND_cmd("atsp" + pnum)
+            for w in self.RTRV_steps(): yield w
+            if self.rx_record != []:
+                self.interpret_at_cmd( self.rx_record )
+
+            # the vehicle may take a while to answer on a protocol, give it all the time there is
+            self.SEND_cmd("0100")
+            for w in self.RTRV_steps(self.rtrv_ceiling): yield w
+
+            # any mode 01 answer means the vehicle is on it
+            if [ line for line in self.rx_record[1:] if '41' in line ] != []:
+                for w in self.SERIAL_FLUSH_steps(): yield w
+                return
+            if self.debug > 0 :
+                print "No answer on protocol", pnum, "- searching"
+
         self.SEND_cmd("atsp0")    # reset protocol
         #self.triage_record( self.RTRV_record() )
-        self.RTRV_record()
+        for w in self.RTRV_steps(): yield w
+        if self.rx_record != []:
+            self.interpret_at_cmd( self.rx_record )
 
         self.SEND_cmd("0100")    # load something to determine the right protocol
-        self.RTRV_record()
+        # the search takes seconds, nothing like the mode 01 replies we learned from
+        for w in self.RTRV_steps(self.rtrv_ceiling): yield w
 
         # just for good measure
-        self.SERIAL_FLUSH_buffers()
+        for w in self.SERIAL_FLUSH_steps(): yield w
+
+
+
+    def ELM327_recover_steps(self):
+        """ Resync, then warm start, then full reset, whichever works first"""
+        # 1. whatever was on its way is lost, look for the prompt again
+        self.recwaiting = 0
+        self.Port.flushInput()
+        self.SEND_cmd("ati")
+        for w in self.RTRV_steps(): yield w
+        if self.ELM327_identified():
+            self.recovered = 1
+            return
+
+        # 2. warm start, skips the LED test and keeps the baud rate,
+        #      then put back the settings made since the last reset
+        self.recwaiting = 0
+        self.SEND_cmd("atws")
+        for w in self.RTRV_steps(): yield w
+        if self.ELM327_identified():
+            replayed = 1
+            for cmd in self.ELM327_replay_cmds():
+                self.SEND_cmd(cmd)
+                for w in self.RTRV_steps(): yield w
+                if self.rx_record == [] or 'OK' not in self.rx_record[-1]:
+                    replayed = 0
+                    break
+                self.interpret_at_cmd( self.rx_record )
+            if replayed:
+                self.recovered = 2
+                return
+
+        # 3. start over
+        self.recwaiting = 0
+        for w in self.reset_steps(): yield w
+        for w in self.reset_protocol_steps(): yield w
+        self.attr_time = {}
+        for w in self.rtrv_attr_steps(self.attr_eager): yield w
+        self.recovered = 3
+
+
+    def ELM327_identified(self):
+        """ Did the last record include the ELM327 ID string"""
+        return [ w for line in self.rx_record for w in line if w.startswith('ELM327') ] != []
+
+
+    def ELM327_replay_cmds(self):
+        """ The AT commands that put back the settings in at_state"""
+        cmds = []
+        for family in self.at_replay:
+            if family == 'ATSP' and self.attr.get('ProtoNum', "Unknown") not in ["Unknown", '?']:
+                # the protocol in use, ie. "ATSPA6" is search starting with 6
+                cmds.append( 'ATSP' + self.attr['ProtoNum'] )
+            elif family in self.at_state:
+                cmds.append( self.at_state[family] )
+        return cmds
+
+
+    def ELM327_lock_protocol(self):
+        """ Stay on the current protocol"""
+        pnum = self.attr.get('ProtoNum', "Unknown")
+        if pnum == "Unknown" or pnum == '?':
+            return
+
+        # "A6" is 6 found automatically, 'A' on its own is a protocol too
+        self.SEND_cmd("atsp" + pnum[-1])
+        self.interpret_at_cmd( self.RTRV_record() )
+        self.attr['ProtoNum'] = pnum[-1]
 
 
 
@@ -778,13 +1278,17 @@ class OBD2reader:
     #
     
     def SERIAL_FLUSH_buffers(self):
+        """Internal use only: not a public interface"""
+        self.run_steps( self.SERIAL_FLUSH_steps() )
+
+    def SERIAL_FLUSH_steps(self):
         """Internal use only: not a public interface"""
         #
         if self.debug > 1:
             print "Trying to flush the recv buffer... (~2 sec wait)"
         #
         # wait 2 secs for something to appear in the buffer
-        time.sleep(2)
+        yield [2, 0]
         # flush both sides
         self.Port.flushOutput()
         self.Port.flushInput()
@@ -797,45 +1301,56 @@ class OBD2reader:
             return 
 
         # SEND
-        if self.Port.writable():
-            #print "\nwriting " + cmd + " to port..."
-            for c in str(cmd):
-                self.Port.write(c)
-            self.Port.write("\r\n")
+        self.SERIAL_SEND_cmd_raw( str(cmd) + "\r\n" )
 
         return
 
+    def SERIAL_SEND_cmd_raw(self, chars):
+        """Private method, write chars to the reader as they are."""
+        if self.Port.writable():
+            #print "\nwriting " + chars + " to port..."
+            for c in chars:
+                self.Port.write(c)
+
     def SERIAL_RTRV_record(self):
         """Private method for retrieving the last command and its result from a serial-connected reader device."""
+        self.run_steps( self.SERIAL_RTRV_steps() )
+        return self.rx_record
+
+    def SERIAL_RTRV_steps(self, max_wait=None):
+        """Private method, SERIAL_RTRV_record() as a series of steps, waiting max_wait seconds if given."""
         # Assumes records are separated by a '>' prompt.
+        self.rx_record = []
         # Must be connected & operational
         if self.State == 0:
             # a slightly more informative result might help
-            return []
-        # max seconds to wait for data
-        max_wait = 3
-        # seconds to wait before trying again
-        try_wait = 0.1
-        tries = max_wait / try_wait
-        # how much we have waited so far
-        waited = 0
+            return
+        self.last_timeout = 0
+        # max seconds to wait for data, learned from earlier replies,
+        #   unless the caller knows better (a protocol search is nothing like a sensor reply)
+        learned = max_wait is None
+        if learned:
+            max_wait = self.rtrv_deadline(self.sent_cmd)
+        # when we started waiting
+        started = monotonic()
+        cc = self.cmd_class(self.sent_cmd)
         # RECV
         raw_record = []
         #  raw_record is a list of non-empty strings, 
         #  each string is a line of info from the reader
         word = ''
         linebuf = []
-        while len(raw_record) < 1 :
-            # we need to have something to reply.. 
+        # an ECU said "response pending" (7F xx 78), the real answer takes longer than usual
+        pending = 0
+        while 1:
+            # only read what is already there, so we never block on the port
             #print "chars waiting:", self.Port.inWaiting()
             #sys.stdout.flush()
             while  self.Port.inWaiting() > 0:
-                while 1:
+                for c in self.Port.read( self.Port.inWaiting() ):
                     # read 1 char at a time 
                     #   until we get to the '>' prompt
                     # 
-                    c = self.Port.read(1)
-                    # 
                     if self.RecordTrace == 1:
                         self.tf_out.write(c)
                     # 
@@ -844,7 +1359,15 @@ class OBD2reader:
                         if self.debug > 2 :
                             print "Raw Record: ",
                             pprint.pprint(raw_record)
-                        return raw_record
+                        self.recv_time = time.time()
+                        self.recv_mono = monotonic()
+                        if learned and not pending:
+                            self.record_latency(self.sent_cmd, self.recv_mono - self.sent_mono)
+                        self.timeout_streak[cc] = 0
+                        if raw_record == []:
+                            self.empty_replies[cc] = self.empty_replies.get(cc, 0) + 1
+                        self.rx_record = raw_record
+                        return
                     # \r = CR , \n = LF 
                     #  (serial device uses CR + optionally LF, unix text only uses LF)
                     # new array entry but only if there is something to add
@@ -854,6 +1377,9 @@ class OBD2reader:
                             word = ''
                         if linebuf != []:
                             raw_record.append(linebuf)
+                            if [ n for n in self.negative_responses( [[], linebuf] ) if n[2] == '78' ] != []:
+                                pending = 1
+                                max_wait = max(max_wait, self.pending_max)
                             linebuf = []
                     # split line into words
                     elif c == ' ':
@@ -867,12 +1393,43 @@ class OBD2reader:
             # wait a bit for the serial line to respond
             if self.debug > 1 :
                 print "NO DATA TO READ!!"
-            if waited < max_wait :
-                waited += try_wait
-                time.sleep(try_wait)
+            left = started + max_wait - monotonic()
+            if left > 0 :
+                yield [left, 1]
             else:
+                if self.debug > 0 :
+                    print "Timed out after", max_wait, "s waiting for reply to:", self.sent_cmd
+                self.timeouts[cc] = self.timeouts.get(cc, 0) + 1
+                self.timeout_streak[cc] = self.timeout_streak.get(cc, 0) + 1
+                self.last_timeout = 1
                 self.recwaiting = 0
-                return []
+                # its reply would be taken for the reply to the next command
+                for w in self.SERIAL_RESYNC_steps(): yield w
+                return
+
+    def SERIAL_RESYNC_steps(self):
+        """Private method, get back in step with a reader still working on a reply we gave up on."""
+        # any character stops the ELM327 ("STOPPED") and it prompts again,
+        #   a space is ignored if it was done after all (a CR would repeat the command)
+        self.SERIAL_SEND_cmd_raw(' ')
+        started = monotonic()
+        while 1:
+            while self.Port.inWaiting() > 0:
+                data = self.Port.read( self.Port.inWaiting() )
+                if self.RecordTrace == 1:
+                    self.tf_out.write(data)
+                if '>' in data:
+                    # whatever is left after the prompt isn't a reply to anything
+                    self.Port.flushInput()
+                    return
+            left = started + self.rtrv_ceiling - monotonic()
+            if left > 0 :
+                yield [left, 1]
+            else:
+                if self.debug > 0 :
+                    print "No prompt from the reader after", self.sent_cmd
+                self.Port.flushInput()
+                return
 
 
 
@@ -976,6 +1533,192 @@ class OBD2reader:
         def __str__(self):
             return repr(self.value)
 
+    class ErrorRequestTimeout(Exception):
+        def __init__(self, value):
+            self.value = value
+        def __str__(self):
+            return repr(self.value)
+
+
+
+class ReaderAttrs(dict):
+    """ The reader's attributes, read from the device the first time they are looked at."""
+    # see OBD2reader.refresh_attr, attr_eager & attr_ttl
+    def __init__(self, reader):
+        dict.__init__(self)
+        self.reader = reader
+
+    def __getitem__(self, name):
+        self.reader.refresh_attr(name)
+        return dict.__getitem__(self, name)
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+    def items(self):
+        return [ (name, self[name]) for name in self.keys() ]
+
+    def values(self):
+        return [ self[name] for name in self.keys() ]
+
+
+
+# the protocol cache is shared by all readers
+proto_lock = threading.Lock()
+
+
+
+class OBD2request:
+    """ An OBD2 command queued for the reader's I/O thread or an OBD2loop, and eventually its result."""
+    def __init__(self, cmd):
+        self.cmd    = cmd
+        self.record = None      # the obd2_record, once it is done
+        self.error  = None      # or the exception raised while doing it
+        self.done   = threading.Event()
+        self.callbacks = []     # called with the request once it is done
+        self.lock   = threading.Lock()
+
+    def run(self, reader):
+        """ Do the command, called by the I/O thread. """
+        try:
+            record = reader.OBD2_cmd(self.cmd)
+        except Exception as e:
+            self.finish(None, e)
+        else:
+            self.finish(record)
+
+    def finish(self, record, error=None):
+        """ Hand over the result and let anyone waiting for it know. """
+        self.lock.acquire()
+        self.record = record
+        self.error  = error
+        self.done.set()
+        callbacks = self.callbacks
+        self.callbacks = []
+        self.lock.release()
+        for fn in callbacks:
+            fn(self)
+
+    def add_callback(self, fn):
+        """ Call fn(request) once it is done, right away if it already is. """
+        self.lock.acquire()
+        if not self.done.is_set():
+            self.callbacks.append(fn)
+            fn = None
+        self.lock.release()
+        if fn is not None:
+            fn(self)
+
+    def result(self, timeout=None):
+        """ Wait for the obd2_record, re-raising anything that went wrong in the I/O thread. """
+        # NB: on an OBD2loop, nothing happens unless the loop runs, see OBD2loop.run_until
+        if not self.done.wait(timeout):
+            raise OBD2reader.ErrorRequestTimeout("No result for " + self.cmd + " yet")
+        if self.error is not None:
+            raise self.error
+        return self.record
+
+
+
+class OBD2loop:
+    """ Drives several OBD2readers from one thread, never blocking on any one of them."""
+    # each reader works through its queue of steps (see OBD2reader.run_steps) one at a time,
+    #   while it waits for its port the loop moves the other readers along
+    def __init__(self):
+        self.tasks = {}     # reader -> list of [steps, request, result function], the first one is running
+        self.wake  = {}     # reader -> [time, readable] the running steps want to go on
+
+    def submit(self, reader, steps, req, result):
+        """ Queue steps to run on reader, req.finish( result() ) once they are done."""
+        if reader not in self.tasks:
+            self.tasks[reader] = []
+            self.wake[reader]  = [monotonic(), 0]
+        self.tasks[reader].append( [steps, req, result] )
+        return req
+
+    def OBD2_cmd(self, reader, cmd):
+        """ Queue an OBD2 command, returns an OBD2request for the obd2_record."""
+        return self.submit( reader, reader.OBD2_cmd_steps(cmd), OBD2request(cmd),
+                            lambda: reader.obd2_record )
+
+    def connect(self, reader):
+        """ Queue connecting to the reader, returns an OBD2request for its State."""
+        return self.submit( reader, reader.connect_steps(), OBD2request('connect'),
+                            lambda: reader.State )
+
+    def step(self, reader):
+        """ Move the running steps of reader along to their next wait."""
+        [steps, req, result] = self.tasks[reader][0]
+        try:
+            [wait, readable] = steps.next()
+        except StopIteration:
+            self.next_task(reader)
+            req.finish( result() )
+        except Exception as e:
+            self.next_task(reader)
+            req.finish(None, e)
+        else:
+            self.wake[reader] = [monotonic() + wait, readable]
+
+    def next_task(self, reader):
+        """ Done with the running steps of reader, start on the next ones."""
+        del self.tasks[reader][0]
+        if self.tasks[reader] == []:
+            del self.tasks[reader]
+            del self.wake[reader]
+        else:
+            self.wake[reader] = [monotonic(), 0]
+
+    def run_once(self, timeout=None):
+        """ Wait for the next reader that can go on (at most timeout seconds), and move it along."""
+        now = monotonic()
+        until = now + timeout if timeout is not None else None
+        selectable = []
+        for reader in self.tasks:
+            [t, readable] = self.wake[reader]
+            if readable:
+                if hasattr(reader.Port, 'fileno'):
+                    selectable.append(reader)
+                else:
+                    # have to keep looking
+                    t = min(t, now + reader.poll_wait)
+            if until is None or t < until:
+                until = t
+
+        if until is None:
+            return
+        wait = max(until - monotonic(), 0)
+        ready = []
+        if selectable != []:
+            [ready, w, x] = select.select(selectable, [], [], wait)
+        elif wait > 0:
+            time.sleep(wait)
+
+        now = monotonic()
+        for reader in self.tasks.keys():
+            if reader in ready or self.wake[reader][0] <= now or \
+               ( self.wake[reader][1] and not hasattr(reader.Port, 'fileno') ):
+                self.step(reader)
+
+    def run_until(self, req, timeout=None):
+        """ Run the loop until req is done (or timeout seconds went by)."""
+        started = monotonic()
+        while not req.done.is_set():
+            left = None
+            if timeout is not None:
+                left = started + timeout - monotonic()
+                if left <= 0:
+                    break
+            self.run_once(left)
+        return req.done.is_set()
+
+    def run(self):
+        """ Run the loop until every reader is done."""
+        while self.tasks != {}:
+            self.run_once()
+
 
 
 
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+############################################################################
+#
+# obd2d.py
+#
+# Copyright 2011 Austin Murphy (austin.murphy@gmail.com)
+#
+# This file is part of OBD2 Scantool.
+#
+# OBD2 Scantool is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# OBD2 Scantool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OBD2 Scantool; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+############################################################################
+
+
+#
+#  Local OBD2 service
+#
+#  Connecting to a reader (reset, protocol search, attributes) takes seconds,
+#    this keeps the readers connected, with the protocol locked,
+#    and answers requests from other programs over a Unix socket
+#
+#  Start the service with the serial ports to keep connected:
+#     obd2d.py /dev/ttyUSB0 [/dev/ttyUSB1 ...]
+#
+#  Ask it something:
+#     obd2d.py query '{"cmd": "scan", "pids": ["010C", "010D"]}'
+#  or from python:
+#     import obd2d
+#     obd2d.query( {'cmd': 'info'} )
+#
+#  Requests and replies are JSON, one per line:
+#     {"cmd": "ports"}                            - the readers & vehicles we have
+#     {"cmd": "info",   "port": P}                - what we know about the vehicle, no vehicle traffic
+#     {"cmd": "scan",   "port": P, "pids": [...]} - fresh decoded readings
+#     {"cmd": "status", "port": P}                - fresh OBD2 status & DTCs
+#  "port" can be left out when there is only one
+#  replies are {"ok": ...} or {"error": "..."}
+#
+
+
+import sys, os, time
+import socket
+import SocketServer
+import threading
+import json
+
+# req'd by obd2_reader
+import serial
+
+# req'd by obd2
+import obd2_reader
+
+# main OBD2 object
+import obd2
+
+
+# debug
+import pprint
+
+
+# where clients find us
+sock_path = '/tmp/obd2d.sock'
+
+# saved capabilities, see OBD2.scan_features_cached
+capfile = 'obd2_capabilities'
+
+# saved protocols, see OBD2reader.cached_protocol
+protofile = 'obd2_protocols'
+
+# timeouts in a row before we try to get back in step with the reader, see OBD2reader.recover
+recover_after = 2
+
+ser_settings = {
+ 'baudrate': 38400,
+ 'bytesize': serial.EIGHTBITS,
+ 'parity'  : serial.PARITY_NONE,
+ 'stopbits': serial.STOPBITS_ONE,
+ 'xonxoff' : False,
+ 'rtscts'  : False,
+ 'dsrdtr'  : False,
+ 'timeout' : None,
+ 'interCharTimeout': None,
+ 'writeTimeout'    : None
+}
+
+
+
+class Bay:
+    """ One reader on one serial port, and the vehicle behind it, kept connected."""
+    def __init__(self, ser_device):
+        self.device  = ser_device
+        self.reader  = None
+        self.vehicle = None
+        # one request at a time per reader
+        self.lock    = threading.Lock()
+
+    def connect(self):
+        """ Connect the reader, learn about the vehicle, lock the protocol."""
+        VIN = None
+        if self.reader is not None:
+            # whatever is left of the last connection
+            self.reader.Port.close()
+        if self.vehicle is not None:
+            # most likely the same vehicle is still there
+            VIN = self.vehicle.info['7E8']['VIN']
+            self.vehicle = None
+
+        port = serial.Serial(None)
+        port.port = self.device
+        port.applySettingsDict(ser_settings)
+
+        self.reader = obd2_reader.OBD2reader( 'SERIAL', 'ELM327' )
+        self.reader.Port = port
+        self.reader.Headers = 1
+        self.reader.ProtoCache = protofile
+        if VIN is not None and VIN != "Unknown":
+            self.reader.VIN = VIN
+        self.reader.connect()
+
+        # each vehicle decodes with its own definitions, the bays take turns with just the decoding (see OBD2.decode)
+        vehicle = obd2.OBD2( self.reader )
+        vehicle.scan_features_cached( capfile )
+        vehicle.scan_basic_info()
+
+        # the search is done, don't do it again
+        self.reader.lock_protocol()
+        # connected only once all of that worked
+        self.vehicle = vehicle
+
+    def connected(self):
+        # a connect that failed part way leaves a reader but no vehicle
+        return self.reader is not None and self.vehicle is not None and self.reader.State == 1
+
+    def close(self):
+        if self.connected():
+            self.reader.disconnect()
+
+    def ports_entry(self):
+        if not self.connected():
+            return { 'State' : 0 }
+        return { 'State'    : self.reader.State,
+                 'VIN'      : self.vehicle.info['7E8']['VIN'],
+                 'ProtoNum' : self.reader.attr['ProtoNum'] }
+
+    def request(self, req):
+        """ Answer one request, reconnecting first if the reader went away."""
+        self.lock.acquire()
+        try:
+            if not self.connected():
+                self.connect()
+            try:
+                reply = self.answer(req)
+            except (obd2_reader.OBD2reader.ErrorNotConnected, serial.SerialException, OSError):
+                # try again on a fresh connection, once
+                self.reader.State = 0
+                self.connect()
+                return self.answer(req)
+            # a reader that stopped answering gets a resync, or a warm start, before the next request
+            if max( self.reader.timeout_streak.values() + [0] ) >= recover_after:
+                self.reader.recover()
+            return reply
+        finally:
+            self.lock.release()
+
+    def answer(self, req):
+        cmd = req.get('cmd')
+        if cmd == 'info':
+            return { 'info'       : self.vehicle.info,
+                     'attr'       : dict( self.reader.attr.items() ),
+                     'suppPIDs'   : self.vehicle.suppPIDs.list(),
+                     'obd2status' : self.vehicle.obd2status }
+        elif cmd == 'scan':
+            # json hands us unicode
+            return self.scan( [ str(pid) for pid in req.get('pids', []) ] )
+        elif cmd == 'status':
+            pids = [ pid for pid in obd2.status_PIDs if pid in self.vehicle.suppPIDs ]
+            if not self.vehicle.pid_blocked('03'):
+                pids.append('03')
+            self.scan(pids)
+            return self.vehicle.obd2status
+        raise ValueError("Unknown request: " + repr(cmd))
+
+    def scan(self, pids):
+        """ Ask the vehicle for pids, returns the decoded records."""
+        records = []
+        for pid in pids:
+            records.extend( self.vehicle.store_reply( pid, self.reader.OBD2_cmd(pid) ) )
+        return records
+
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    """ Requests from one client, a JSON object per line."""
+    def handle(self):
+        bays = self.server.bays
+        for line in self.rfile:
+            if line.strip() == '':
+                continue
+            try:
+                req = json.loads(line)
+                if req.get('cmd') == 'ports':
+                    reply = { 'ok' : dict( [ (d, bays[d].ports_entry()) for d in bays ] ) }
+                else:
+                    device = req.get('port')
+                    if device is None and len(bays) == 1:
+                        device = bays.keys()[0]
+                    if device not in bays:
+                        raise ValueError("Unknown port: " + repr(device))
+                    reply = { 'ok' : bays[device].request(req) }
+            except Exception as e:
+                reply = { 'error' : repr(e) }
+            self.wfile.write( json.dumps(reply) + "\n" )
+            self.wfile.flush()
+
+
+
+class OBD2server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+
+def query(req, path=sock_path):
+    """ Send one request to the running service, return the reply."""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(path)
+    try:
+        f = s.makefile('r+b')
+        f.write( json.dumps(req) + "\n" )
+        f.flush()
+        reply = json.loads( f.readline() )
+        f.close()
+    finally:
+        s.close()
+    if 'error' in reply:
+        raise RuntimeError(reply['error'])
+    return reply['ok']
+
+
+
+def main():
+    """ Run the service, or ask it something """
+
+    if len(sys.argv) < 2:
+        sys.exit('Usage: %s serial_port [serial_port ...]\n       %s query JSON_request' % (sys.argv[0], sys.argv[0]))
+
+    if sys.argv[1] == 'query':
+        pprint.pprint( query( json.loads(sys.argv[2]) ) )
+        return
+
+    obd2.load_pids_from_csv( 'obd2_std_PIDs.csv' )
+    obd2.load_dtcs_from_csv( 'obd2_std_DTCs.csv' )
+
+    bays = {}
+    for ser_device in sys.argv[1:]:
+        bays[ser_device] = Bay(ser_device)
+        print "Connecting to", ser_device, "..."
+        try:
+            bays[ser_device].connect()
+            print "  ", bays[ser_device].ports_entry()
+        except Exception as e:
+            # try again when someone asks for it
+            print "  failed:", repr(e)
+
+    if os.path.exists(sock_path):
+        os.unlink(sock_path)
+    server = OBD2server(sock_path, RequestHandler)
+    server.bays = bays
+    print "Listening on", sock_path
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(sock_path)
+        for b in bays.values():
+            b.close()
+
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())